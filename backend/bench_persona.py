@@ -0,0 +1,64 @@
+"""Micro-benchmark for persona classification.
+
+Compares the precompiled keyword-table classifier against the previous
+per-keyword substring scan on a mix of realistic task titles.
+
+    python bench_persona.py [--titles 10000] [--repeat 5]
+"""
+import argparse
+import random
+import timeit
+
+from persona_system import PERSONAS, classify_task_persona, classify_task_personas
+
+SAMPLE_TITLES = [
+    "Pay rent and review budget",
+    "Morning run 5k",
+    "Study for chemistry exam",
+    "Prepare slides for client presentation",
+    "Clean the kitchen and do laundry",
+    "Write a chapter of my novel",
+    "10 minute meditation before bed",
+    "Meal prep chicken and rice for the week",
+    "Call mom",
+    "Renew passport",
+    "Transfer $200 to savings account",
+    "Leg day at the gym",
+]
+
+
+def substring_classify(title: str, description: str = "") -> str:
+    """The original classifier: substring test of every keyword of every persona."""
+    text = f"{title} {description}".lower()
+    best_persona, best_score = "life", 0
+    for persona_id, persona in PERSONAS.items():
+        score = sum(len(keyword) for keyword in persona["keywords"] if keyword in text)
+        if score > best_score:
+            best_persona, best_score = persona_id, score
+    return best_persona
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--titles", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    titles = [rng.choice(SAMPLE_TITLES) for _ in range(args.titles)]
+
+    runs = {
+        "substring scan": lambda: [substring_classify(t) for t in titles],
+        "keyword table": lambda: [classify_task_persona(t) for t in titles],
+        "keyword table batch": lambda: classify_task_personas(titles),
+    }
+    baseline = None
+    for name, fn in runs.items():
+        best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        per_title = best / len(titles) * 1e6
+        baseline = baseline or best
+        print(f"{name:<20} {best * 1000:8.1f} ms  {per_title:6.2f} us/title  {baseline / best:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
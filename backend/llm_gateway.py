@@ -0,0 +1,419 @@
+"""Application-scoped LLM client for TASKLY - one keep-alive connection pool per provider"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Iterable, List, Optional, Tuple
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+PROVIDERS = ("anthropic", "openai", "gemini")
+# OpenAI-compatible proxy in front of every provider, reached with the Emergent LLM key
+DEFAULT_BASE_URL = "https://integrations.emergentagent.com/llm"
+
+# Lower runs first: cheap interactive calls ahead of long chats, background refreshes last
+PRIORITY_SUGGEST = 0
+PRIORITY_BREAKDOWN = 1
+PRIORITY_CHAT = 2
+PRIORITY_BACKGROUND = 3
+
+
+class LLMError(Exception):
+    """The provider answered with an error status or an unusable body."""
+
+
+class LLMOverloaded(LLMError):
+    """The call was shed by the scheduler instead of being sent to the provider."""
+
+
+class LLMScheduler:
+    """Per-provider concurrency caps with a priority queue that is fair across users.
+
+    At most `concurrency` calls per provider are in flight. Waiting calls are
+    served lowest priority number first and, within a priority, round-robin
+    across users so one user's burst cannot starve everyone else. Calls are
+    shed early with LLMOverloaded - when their priority's queue already holds
+    `max_queue` waiters, or when they waited longer than `max_wait[priority]` -
+    so callers can answer with a fallback instead of running into a timeout.
+    """
+
+    def __init__(self, concurrency: int = 8, max_queue: int = 50,
+                 max_wait: Optional[Dict[int, float]] = None):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait or {
+            PRIORITY_SUGGEST: 2.0, PRIORITY_BREAKDOWN: 3.0, PRIORITY_CHAT: 5.0, PRIORITY_BACKGROUND: 30.0
+        }
+        self._active: Dict[str, int] = {}
+        # provider -> priority -> user -> waiting futures
+        self._queues: Dict[str, Dict[int, "OrderedDict[str, Deque[asyncio.Future]]"]] = {}
+        self.shed = 0
+        self.queued = 0
+
+    def _waiting(self, provider: str, priority: int) -> int:
+        users = self._queues.get(provider, {}).get(priority, {})
+        return sum(len(waiters) for waiters in users.values())
+
+    @asynccontextmanager
+    async def slot(self, provider: str, priority: int = PRIORITY_CHAT, user_id: Optional[str] = None):
+        if self._active.get(provider, 0) < self.concurrency and not self._has_waiters(provider):
+            self._active[provider] = self._active.get(provider, 0) + 1
+        else:
+            await self._enqueue(provider, priority, user_id or "")
+        try:
+            yield
+        finally:
+            self._release(provider)
+
+    def _has_waiters(self, provider: str) -> bool:
+        return any(users for users in self._queues.get(provider, {}).values())
+
+    async def _enqueue(self, provider: str, priority: int, user_id: str):
+        if self._waiting(provider, priority) >= self.max_queue:
+            self.shed += 1
+            raise LLMOverloaded(f"{provider} queue full at priority {priority}")
+        waiter = asyncio.get_running_loop().create_future()
+        users = self._queues.setdefault(provider, {}).setdefault(priority, OrderedDict())
+        users.setdefault(user_id, deque()).append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.max_wait.get(priority))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                self._release(provider)  # the slot was handed over as we gave up
+            else:
+                waiter.cancel()
+                self._forget(provider, priority, user_id, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.shed += 1
+                raise LLMOverloaded(f"{provider} queue wait exceeded at priority {priority}") from None
+            raise
+
+    def _forget(self, provider: str, priority: int, user_id: str, waiter: "asyncio.Future"):
+        users = self._queues[provider][priority]
+        waiters = users.get(user_id)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del users[user_id]
+
+    def _release(self, provider: str):
+        """Hand the freed slot straight to the next waiter, or give it back."""
+        for priority in sorted(self._queues.get(provider, {})):
+            users = self._queues[provider][priority]
+            while users:
+                user_id, waiters = next(iter(users.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    users.move_to_end(user_id)  # round-robin across users
+                else:
+                    del users[user_id]
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self._active[provider] = self._active.get(provider, 1) - 1
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "concurrency": self.concurrency,
+            "active": dict(self._active),
+            "waiting": {p: sum(self._waiting(p, pr) for pr in qs) for p, qs in self._queues.items()},
+            "queued": self.queued,
+            "shed": self.shed,
+        }
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram; quantiles resolve to a bucket's upper bound."""
+
+    BUCKETS = (0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 4.0, 5.0, 6.0, 8.0, 10.0, 12.0, 15.0, 20.0, 30.0)
+
+    def __init__(self):
+        self.counts: List[int] = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+
+    def record(self, seconds: float):
+        index = next((i for i, bound in enumerate(self.BUCKETS) if seconds <= bound), len(self.BUCKETS))
+        self.counts[index] += 1
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.BUCKETS[index] if index < len(self.BUCKETS) else float("inf")
+        return float("inf")
+
+    def snapshot(self) -> Dict[str, Optional[float]]:
+        return {"count": self.count, "p50": self.quantile(0.5), "p95": self.quantile(0.95)}
+
+
+class LLMGateway:
+    """Chat completions for every provider behind one scheduler, with latency stats and hedging.
+
+    Call `start()` once at application startup and `close()` at shutdown;
+    handlers then only pass provider, model, system message and text.
+
+    Each provider uses one of two transports:
+
+    - http (default; `base_url`, or `base_urls[provider]`): a pooled httpx
+      client per provider, so a slow provider cannot starve the others of
+      connections, with token-by-token streaming. The endpoint must speak
+      OpenAI chat completions:
+      `POST {url}/chat/completions` with `Authorization: Bearer <api_key>` and
+      `{"model": "<provider>/<model>", "messages": [...], "stream": bool}`,
+      answering `choices[0].message.content`, or for `stream: true` an event
+      stream of `data: {"choices": [{"delta": {"content": ...}}]}` lines ended
+      by `data: [DONE]`. tests/test_llm_gateway.py checks the endpoint
+      against this contract when EMERGENT_LLM_KEY is set.
+    - sdk (no URL, or fallback): the vendor's `emergentintegrations` LlmChat
+      client, one instance per call since it keeps the session's history. It
+      has no streaming API, so `stream()` yields the whole reply as one delta.
+
+    `verify()` probes every http provider once at startup and moves the ones
+    whose endpoint does not answer the contract to the sdk transport.
+    """
+
+    def __init__(self, api_key: str, base_url: Optional[str] = DEFAULT_BASE_URL, providers: Iterable[str] = PROVIDERS,
+                 base_urls: Optional[Dict[str, str]] = None, timeout: float = 30.0,
+                 max_connections: int = 20, keepalive_expiry: float = 60.0,
+                 scheduler: Optional[LLMScheduler] = None):
+        self.api_key = api_key
+        self.scheduler = scheduler or LLMScheduler(concurrency=max_connections)
+        self.base_urls = {p: (base_urls or {}).get(p, base_url) or None for p in providers}
+        self.timeout = timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self.requests = {p: 0 for p in self.base_urls}
+        self.errors = {p: 0 for p in self.base_urls}
+        # Time to the whole reply (complete) or to the first token (stream)
+        self.latency = {p: LatencyHistogram() for p in self.base_urls}
+        self.hedges = 0
+        self.hedge_wins = 0
+        # http providers whose startup probe came back in a single chunk
+        self.buffered: set = set()
+
+    async def start(self):
+        for provider, base_url in self.base_urls.items():
+            if base_url and provider not in self._clients:
+                self._clients[provider] = httpx.AsyncClient(
+                    base_url=base_url.rstrip("/"),
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                    timeout=self.timeout,
+                    limits=self.limits
+                )
+
+    async def verify(self, models: Dict[str, str], timeout: float = 15.0) -> Dict[str, str]:
+        """Stream a short probe through every http provider with its `models` entry.
+
+        A provider whose endpoint errors, times out or sends nothing is logged
+        and switched to the sdk transport; one that answers in a single delta
+        is logged as not streaming. Returns provider -> transport afterwards.
+        """
+        probes = [p for p in self.base_urls if self.transport(p) == "http" and p in models]
+        results = await asyncio.gather(
+            *(asyncio.wait_for(self._probe(p, models[p]), timeout) for p in probes), return_exceptions=True
+        )
+        for provider, result in zip(probes, results):
+            if isinstance(result, int) and result > 1:
+                continue
+            if isinstance(result, int) and result == 1:
+                logger.error(f"LLM endpoint {self.base_urls[provider]} answered {provider} in one chunk; replies will not stream")
+                self.buffered.add(provider)
+                continue
+            reason = "an empty reply" if isinstance(result, int) else repr(result)
+            logger.error(
+                f"LLM endpoint {self.base_urls[provider]} failed the {provider} probe with {reason}; "
+                f"falling back to the SDK transport, without streaming"
+            )
+            self.base_urls[provider] = None
+            client = self._clients.pop(provider, None)
+            if client is not None:
+                await client.aclose()
+        return {p: self.transport(p) for p in self.base_urls}
+
+    async def _probe(self, provider: str, model: str) -> int:
+        system_message = "You are a connectivity check. Follow the instruction exactly."
+        text = "Count from 1 to 5, one number per line."
+        return len([delta async for delta in self._stream(self._client(provider), provider, model, system_message, text)])
+
+    async def close(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def transport(self, provider: str) -> str:
+        return "http" if self.base_urls.get(provider) else "sdk"
+
+    def streams(self, provider: str) -> bool:
+        """Whether `stream()` on `provider` yields tokens as they arrive rather than one final delta."""
+        return self.transport(provider) == "http" and provider not in self.buffered
+
+    def _client(self, provider: str) -> Optional[httpx.AsyncClient]:
+        if self.transport(provider) == "sdk":
+            return None
+        client = self._clients.get(provider)
+        if client is None:
+            raise LLMError(f"LLM gateway has no client for '{provider}' (not started?)")
+        return client
+
+    @staticmethod
+    def _payload(provider: str, model: str, system_message: str, text: str, stream: bool) -> dict:
+        return {
+            "model": f"{provider}/{model}",
+            "messages": [{"role": "system", "content": system_message}, {"role": "user", "content": text}],
+            "stream": stream,
+        }
+
+    async def complete(self, provider: str, model: str, system_message: str, text: str,
+                       priority: int = PRIORITY_CHAT, user_id: Optional[str] = None) -> str:
+        """Return the full reply text."""
+        client = self._client(provider)
+        async with self.scheduler.slot(provider, priority, user_id):
+            if client is None:
+                return await self._complete_sdk(provider, model, system_message, text)
+            return await self._complete(client, provider, model, system_message, text)
+
+    async def _complete_sdk(self, provider: str, model: str, system_message: str, text: str) -> str:
+        self.requests[provider] += 1
+        started = time.monotonic()
+        try:
+            from emergentintegrations.llm.chat import LlmChat, UserMessage
+            chat = LlmChat(api_key=self.api_key, session_id=f"gateway_{uuid.uuid4().hex[:8]}", system_message=system_message)
+            chat.with_model(provider, model)
+            reply = await chat.send_message(UserMessage(text=text))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors[provider] += 1
+            raise LLMError(f"{provider} request failed: {e}") from e
+        self.latency[provider].record(time.monotonic() - started)
+        return reply
+
+    async def _complete(self, client: httpx.AsyncClient, provider: str, model: str, system_message: str, text: str) -> str:
+        self.requests[provider] += 1
+        started = time.monotonic()
+        try:
+            response = await client.post("/chat/completions", json=self._payload(provider, model, system_message, text, False))
+            if response.status_code in (401, 404):
+                logger.error(f"LLM endpoint for {provider} rejected '{provider}/{model}' ({response.status_code}); check LLM base URL and model naming")
+            if response.status_code >= 400:
+                raise LLMError(f"{provider} returned {response.status_code}: {response.text[:200]}")
+            reply = response.json()["choices"][0]["message"]["content"]
+            self.latency[provider].record(time.monotonic() - started)
+            return reply
+        except (httpx.HTTPError, KeyError, IndexError, ValueError) as e:
+            self.errors[provider] += 1
+            raise LLMError(f"{provider} request failed: {e}") from e
+        except LLMError:
+            self.errors[provider] += 1
+            raise
+
+    async def stream(self, provider: str, model: str, system_message: str, text: str,
+                     priority: int = PRIORITY_CHAT, user_id: Optional[str] = None) -> AsyncIterator[str]:
+        """Yield reply text deltas as the provider sends them (holding one slot for the whole reply)."""
+        client = self._client(provider)
+        async with self.scheduler.slot(provider, priority, user_id):
+            if client is None:
+                yield await self._complete_sdk(provider, model, system_message, text)
+                return
+            async for delta in self._stream(client, provider, model, system_message, text):
+                yield delta
+
+    async def _stream(self, client: httpx.AsyncClient, provider: str, model: str, system_message: str, text: str) -> AsyncIterator[str]:
+        self.requests[provider] += 1
+        started = time.monotonic()
+        first = True
+        payload = self._payload(provider, model, system_message, text, True)
+        try:
+            async with client.stream("POST", "/chat/completions", json=payload) as response:
+                if response.status_code >= 400:
+                    body = await response.aread()
+                    raise LLMError(f"{provider} returned {response.status_code}: {body[:200]!r}")
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    choices = json.loads(data).get("choices") or [{}]
+                    delta = choices[0].get("delta", {}).get("content")
+                    if delta:
+                        if first:
+                            self.latency[provider].record(time.monotonic() - started)
+                            first = False
+                        yield delta
+        except (httpx.HTTPError, ValueError) as e:
+            self.errors[provider] += 1
+            raise LLMError(f"{provider} stream failed: {e}") from e
+        except LLMError:
+            self.errors[provider] += 1
+            raise
+
+    def hedge_delay(self, provider: str, min_samples: int = 20, default: float = 4.0,
+                    floor: float = 0.5, ceiling: float = 8.0) -> float:
+        """How long to give `provider` before hedging: its p95, once there are enough samples."""
+        histogram = self.latency[provider]
+        if histogram.count < min_samples:
+            return default
+        return min(max(histogram.quantile(0.95), floor), ceiling)
+
+    async def complete_hedged(self, primary: Tuple[str, str], secondary: Tuple[str, str],
+                              system_message: str, text: str, priority: int = PRIORITY_CHAT,
+                              user_id: Optional[str] = None) -> Tuple[str, str]:
+        """Complete on `primary` (provider, model), hedging onto `secondary` if it is slow or fails.
+
+        The secondary is fired when the primary has not answered within its
+        p95-derived hedge delay, or as soon as the primary errors. The first
+        successful reply wins and the other call is cancelled. Returns
+        (reply, provider that answered).
+        """
+        racers = {asyncio.ensure_future(self.complete(*primary, system_message, text, priority, user_id)): primary[0]}
+        try:
+            done, _ = await asyncio.wait(racers, timeout=self.hedge_delay(primary[0]))
+            if not done or next(iter(done)).exception():
+                self.hedges += 1
+                racers[asyncio.ensure_future(self.complete(*secondary, system_message, text, priority, user_id))] = secondary[0]
+            error: Optional[BaseException] = None
+            while racers:
+                done, _ = await asyncio.wait(racers, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    provider = racers.pop(task)
+                    if task.exception() is None:
+                        if provider != primary[0]:
+                            self.hedge_wins += 1
+                        return task.result(), provider
+                    error = task.exception()
+            raise error
+        finally:
+            for task in racers:
+                task.cancel()
+
+    def stats(self) -> Dict[str, object]:
+        providers = {
+            p: {
+                "transport": self.transport(p), "streams": self.streams(p), "requests": self.requests[p], "errors": self.errors[p],
+                "latency": self.latency[p].snapshot()
+            }
+            for p in self.base_urls
+        }
+        return {
+            "providers": providers,
+            "scheduler": self.scheduler.stats(),
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
@@ -0,0 +1,381 @@
+"""Maintenance jobs for TASKLY - run from the backend directory.
+
+Usage:
+    python maintenance.py reconcile-stats [--user USER_ID] [--batch-size N]
+    python maintenance.py backfill-activity [--user USER_ID] [--batch-size N]
+    python maintenance.py backfill-updated-at
+    python maintenance.py migrate-subtask-ids [--batch-size N]
+    python maintenance.py backfill-chat-expiry
+    python maintenance.py reclassify-personas [--user USER_ID] [--batch-size N] [--resume]
+"""
+
+import argparse
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timezone
+
+from pymongo import ReturnDocument, UpdateOne
+
+from persona_system import classify_task_personas
+from server import db, empty_task_stats, persona_fields, user_cache, CHAT_RETENTION_DAYS
+
+logger = logging.getLogger("maintenance")
+
+
+RECONCILE_ATTEMPTS = 3
+
+
+async def reconcile_stats(user_id: str = None, batch_size: int = 500):
+    """Rebuild materialized `task_stats` counters from the tasks collection.
+
+    Users are streamed in batches; each batch costs one grouped aggregation over
+    its users' tasks plus one bulk_write. Each write is conditioned on the
+    counters read before recounting, so a live $inc that lands meanwhile makes
+    it miss; those users are recounted again, up to RECONCILE_ATTEMPTS times.
+    """
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    query = {"user_id": user_id} if user_id else {}
+    cursor = db.users.find(query, {"_id": 0, "user_id": 1}).batch_size(batch_size)
+    processed = 0
+    batch = []
+    async for user in cursor:
+        batch.append(user["user_id"])
+        if len(batch) >= batch_size:
+            processed += await _reconcile_batch(batch, today)
+            batch = []
+    if batch:
+        processed += await _reconcile_batch(batch, today)
+    logger.info(f"reconcile-stats: rebuilt counters for {processed} users")
+    return processed
+
+
+async def _reconcile_batch(user_ids: list, today: str) -> int:
+    rebuilt = 0
+    for _ in range(RECONCILE_ATTEMPTS):
+        # Snapshot first: any counter change after this makes the conditional write miss
+        snapshots = await _task_stats(user_ids)
+        rows = await db.tasks.aggregate([
+            {"$match": {"user_id": {"$in": list(snapshots)}}},
+            {"$group": {
+                "_id": "$user_id",
+                "total": {"$sum": 1},
+                "completed": {"$sum": {"$cond": [{"$eq": ["$completed", True]}, 1, 0]}},
+                "completed_today": {"$sum": {"$cond": [
+                    {"$and": [{"$eq": ["$completed", True]}, {"$gte": ["$completed_at", today]}]}, 1, 0
+                ]}}
+            }}
+        ]).to_list(None)
+        by_user = {row["_id"]: row for row in rows}
+        recounted = {}
+        ops = []
+        for user_id, snapshot in snapshots.items():
+            stats = empty_task_stats()
+            row = by_user.get(user_id)
+            if row:
+                stats.update({k: row[k] for k in ("total", "completed", "completed_today")})
+            stats["today"] = today
+            recounted[user_id] = stats
+            guard = {"task_stats": snapshot} if snapshot is not None else {"task_stats": {"$exists": False}}
+            ops.append(UpdateOne(
+                {"user_id": user_id, **guard},
+                {"$set": {"task_stats": stats}, "$inc": {"data_version": 1}}
+            ))
+        if not ops:
+            user_ids = []
+            break
+        await db.users.bulk_write(ops, ordered=False)
+        current = await _task_stats(list(recounted))
+        user_ids = [u for u, stats in recounted.items() if current.get(u) != stats]
+        for user_id in recounted:
+            if user_id not in user_ids:
+                user_cache.pop(user_id)
+        rebuilt += len(recounted) - len(user_ids)
+        if not user_ids:
+            break
+    if user_ids:
+        logger.warning(f"reconcile-stats: counters of {len(user_ids)} users kept changing; left for the next run")
+        for user_id in user_ids:
+            user_cache.pop(user_id)
+    return rebuilt
+
+
+async def _task_stats(user_ids: list) -> dict:
+    users = await db.users.find({"user_id": {"$in": user_ids}}, {"_id": 0, "user_id": 1, "task_stats": 1}).to_list(None)
+    return {u["user_id"]: u.get("task_stats") for u in users}
+
+
+async def _touch_users(user_ids):
+    """Bump data_version for users whose data a job changed, so ETags stop answering 304, and drop cached copies."""
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), 1000):
+        chunk = user_ids[i:i + 1000]
+        await db.users.update_many({"user_id": {"$in": chunk}}, {"$inc": {"data_version": 1}})
+        for user_id in chunk:
+            user_cache.pop(user_id)
+
+
+async def backfill_activity(user_id: str = None, batch_size: int = 500):
+    """Rebuild the `daily_activity` rollup from completed tasks.
+
+    Idempotent: each (user_id, date) row is overwritten with the recount.
+    Completions of tasks that have since been deleted cannot be recovered.
+    """
+    match = {"completed": True, "completed_at": {"$type": "string"}}
+    if user_id:
+        match["user_id"] = user_id
+    cursor = db.tasks.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "date": {"$substrBytes": ["$completed_at", 0, 10]}},
+            "completed": {"$sum": 1},
+            "xp": {"$sum": {"$ifNull": ["$xp_earned", 0]}},
+            "minutes": {"$sum": {"$ifNull": ["$estimated_time", 0]}}
+        }}
+    ], allowDiskUse=True)
+    written = 0
+    ops = []
+    user_ids = set()
+    async for row in cursor:
+        key = row["_id"]
+        user_ids.add(key["user_id"])
+        ops.append(UpdateOne(
+            {"user_id": key["user_id"], "date": key["date"]},
+            {"$set": {"completed": row["completed"], "xp": row["xp"], "minutes": row["minutes"]}},
+            upsert=True
+        ))
+        if len(ops) >= batch_size:
+            await db.daily_activity.bulk_write(ops, ordered=False)
+            await _touch_users(user_ids)
+            written += len(ops)
+            ops, user_ids = [], set()
+    if ops:
+        await db.daily_activity.bulk_write(ops, ordered=False)
+        await _touch_users(user_ids)
+        written += len(ops)
+    logger.info(f"backfill-activity: wrote {written} daily rows")
+    return written
+
+
+async def backfill_updated_at():
+    """Stamp `updated_at = created_at` on tasks written before delta sync existed.
+
+    Sync pages are keyed on updated_at, so tasks without it can only be picked
+    up reliably by a full sync that fits in one page.
+    """
+    query = {"updated_at": {"$exists": False}}
+    user_ids = await db.tasks.distinct("user_id", query)
+    result = await db.tasks.update_many(query, [{"$set": {"updated_at": "$created_at"}}])
+    await _touch_users(user_ids)
+    logger.info(f"backfill-updated-at: stamped {result.modified_count} tasks")
+    return result.modified_count
+
+
+async def migrate_subtask_ids(batch_size: int = 500):
+    """Give every legacy subtask a `subtask_id` so toggles can address it atomically.
+
+    Each rewrite is conditioned on the subtasks array being unchanged since it
+    was read, so a concurrent edit is never overwritten (it is simply skipped).
+    """
+    cursor = db.tasks.find(
+        {"subtasks": {"$elemMatch": {"subtask_id": {"$exists": False}}}},
+        {"_id": 1, "user_id": 1, "subtasks": 1}
+    ).batch_size(batch_size)
+    migrated = 0
+    ops = []
+    user_ids = set()
+    async for task in cursor:
+        user_ids.add(task["user_id"])
+        subtasks = [
+            st if st.get("subtask_id") else {**st, "subtask_id": f"st_{uuid.uuid4().hex[:8]}"}
+            for st in task["subtasks"]
+        ]
+        ops.append(UpdateOne({"_id": task["_id"], "subtasks": task["subtasks"]}, {"$set": {"subtasks": subtasks}}))
+        if len(ops) >= batch_size:
+            migrated += (await db.tasks.bulk_write(ops, ordered=False)).modified_count
+            await _touch_users(user_ids)
+            ops, user_ids = [], set()
+    if ops:
+        migrated += (await db.tasks.bulk_write(ops, ordered=False)).modified_count
+        await _touch_users(user_ids)
+    logger.info(f"migrate-subtask-ids: migrated {migrated} tasks")
+    return migrated
+
+
+async def backfill_chat_expiry():
+    """Stamp `expires_at` on chat messages and summaries written before retention existed.
+
+    Uses the same retention window as new messages, counted from each
+    message's created_at (a summary's updated_at, i.e. its last exchange), so
+    the TTL indexes can reclaim old history.
+    """
+    retention_ms = CHAT_RETENTION_DAYS * 24 * 3600 * 1000
+    stamped = 0
+    for collection, field in ((db.chat_messages, "created_at"), (db.persona_chats, "created_at"),
+                              (db.chat_summaries, "updated_at")):
+        result = await collection.update_many(
+            {"expires_at": {"$exists": False}, field: {"$type": "string"}},
+            [{"$set": {"expires_at": {"$add": [{"$dateFromString": {"dateString": f"${field}"}}, retention_ms]}}}]
+        )
+        stamped += result.modified_count
+    logger.info(f"backfill-chat-expiry: stamped {stamped} messages and summaries")
+    return stamped
+
+
+RECLASSIFY_JOB = "reclassify-personas"
+PERSONA_PROJECTION = {
+    "_id": 1, "user_id": 1, "title": 1, "description": 1,
+    "persona_id": 1, "persona_name": 1, "persona_emoji": 1, "persona_color": 1,
+}
+
+
+async def start_reclassify_personas(user_id: str = None, batch_size: int = 500, resume: bool = False):
+    """Create (or, with `resume`, reopen the latest unfinished) reclassification job.
+
+    Returns (job, run): the job document as stored in `jobs`, and the coroutine
+    that does the work, so the API can run it in the background while the CLI
+    simply awaits it.
+    """
+    scope = user_id or "all"
+    now = datetime.now(timezone.utc).isoformat()
+    job = None
+    if resume:
+        job = await db.jobs.find_one_and_update(
+            {"name": RECLASSIFY_JOB, "scope": scope, "status": {"$ne": "completed"}},
+            {"$set": {"status": "running", "updated_at": now}, "$unset": {"error": ""}},
+            sort=[("started_at", -1)],
+            return_document=ReturnDocument.AFTER
+        )
+    if job is None:
+        job = {
+            "job_id": f"job_{uuid.uuid4().hex[:12]}",
+            "name": RECLASSIFY_JOB,
+            "scope": scope,
+            "status": "running",
+            "processed": 0,
+            "changed": 0,
+            "last_id": None,
+            "started_at": now,
+            "updated_at": now,
+        }
+        await db.jobs.insert_one(dict(job))
+    public = {k: v for k, v in job.items() if k not in ("_id", "last_id")}
+    return public, _reclassify_personas(job, user_id, batch_size)
+
+
+async def reclassify_personas(user_id: str = None, batch_size: int = 500, resume: bool = False):
+    """Recompute the denormalized persona fields of existing tasks.
+
+    Tasks are streamed in `_id` order and classified a batch at a time; only
+    tasks whose persona fields change are written, with one bulk_write per
+    batch. After each batch the last `_id` is checkpointed in `jobs`, so an
+    interrupted run continues where it stopped with --resume.
+    """
+    job, run = await start_reclassify_personas(user_id, batch_size, resume)
+    logger.info(f"{RECLASSIFY_JOB}: {'resuming' if job['processed'] else 'starting'} {job['job_id']} ({job['scope']})")
+    return await run
+
+
+async def _reclassify_personas(job: dict, user_id: str, batch_size: int):
+    query = {"user_id": user_id} if user_id else {}
+    if job["last_id"] is not None:
+        query["_id"] = {"$gt": job["last_id"]}
+    cursor = db.tasks.find(query, PERSONA_PROJECTION).sort("_id", 1).batch_size(batch_size)
+    processed, changed = job["processed"], job["changed"]
+    batch = []
+    try:
+        async for task in cursor:
+            batch.append(task)
+            if len(batch) >= batch_size:
+                changed += await _reclassify_batch(batch)
+                processed += len(batch)
+                await _checkpoint(job["job_id"], processed, changed, batch[-1]["_id"])
+                batch = []
+        if batch:
+            changed += await _reclassify_batch(batch)
+            processed += len(batch)
+            await _checkpoint(job["job_id"], processed, changed, batch[-1]["_id"])
+    except Exception as e:
+        await db.jobs.update_one({"job_id": job["job_id"]}, {"$set": {"status": "failed", "error": str(e)}})
+        logger.error(f"{RECLASSIFY_JOB}: {job['job_id']} failed after {processed} tasks: {e}")
+        raise
+    await db.jobs.update_one(
+        {"job_id": job["job_id"]},
+        {"$set": {"status": "completed", "finished_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    logger.info(f"{RECLASSIFY_JOB}: scanned {processed} tasks, reclassified {changed}")
+    return processed, changed
+
+
+async def _reclassify_batch(tasks: list) -> int:
+    persona_ids = classify_task_personas([(t.get("title") or "", t.get("description") or "") for t in tasks])
+    now = datetime.now(timezone.utc).isoformat()
+    ops = []
+    user_ids = set()
+    for task, persona_id in zip(tasks, persona_ids):
+        fields = persona_fields(persona_id)
+        if any(task.get(k) != v for k, v in fields.items()):
+            # Skip tasks edited since they were read; update_task reclassifies those itself
+            ops.append(UpdateOne(
+                {"_id": task["_id"], "title": task.get("title"), "description": task.get("description")},
+                {"$set": {**fields, "updated_at": now}}
+            ))
+            user_ids.add(task["user_id"])
+    if not ops:
+        return 0
+    modified = (await db.tasks.bulk_write(ops, ordered=False)).modified_count
+    await _touch_users(user_ids)
+    return modified
+
+
+async def _checkpoint(job_id: str, processed: int, changed: int, last_id):
+    await db.jobs.update_one({"job_id": job_id}, {"$set": {
+        "processed": processed,
+        "changed": changed,
+        "last_id": last_id,
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }})
+    logger.info(f"{RECLASSIFY_JOB}: {processed} tasks scanned, {changed} reclassified")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TASKLY maintenance jobs")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    reconcile = sub.add_parser("reconcile-stats", help="Rebuild per-user task counters")
+    reconcile.add_argument("--user", dest="user_id", help="Only rebuild this user")
+    reconcile.add_argument("--batch-size", type=int, default=500)
+
+    backfill = sub.add_parser("backfill-activity", help="Rebuild the daily_activity rollup")
+    backfill.add_argument("--user", dest="user_id", help="Only backfill this user")
+    backfill.add_argument("--batch-size", type=int, default=500)
+
+    sub.add_parser("backfill-updated-at", help="Stamp updated_at on legacy tasks for delta sync")
+
+    migrate = sub.add_parser("migrate-subtask-ids", help="Assign ids to legacy subtasks")
+    migrate.add_argument("--batch-size", type=int, default=500)
+
+    sub.add_parser("backfill-chat-expiry", help="Stamp expires_at on legacy chat messages and summaries")
+
+    reclassify = sub.add_parser(RECLASSIFY_JOB, help="Recompute task personas after keyword changes")
+    reclassify.add_argument("--user", dest="user_id", help="Only reclassify this user's tasks")
+    reclassify.add_argument("--batch-size", type=int, default=500)
+    reclassify.add_argument("--resume", action="store_true", help="Continue the latest unfinished run")
+
+    args = parser.parse_args()
+    if args.command == "reconcile-stats":
+        asyncio.run(reconcile_stats(args.user_id, args.batch_size))
+    elif args.command == "backfill-activity":
+        asyncio.run(backfill_activity(args.user_id, args.batch_size))
+    elif args.command == "backfill-updated-at":
+        asyncio.run(backfill_updated_at())
+    elif args.command == "migrate-subtask-ids":
+        asyncio.run(migrate_subtask_ids(args.batch_size))
+    elif args.command == "backfill-chat-expiry":
+        asyncio.run(backfill_chat_expiry())
+    elif args.command == RECLASSIFY_JOB:
+        asyncio.run(reclassify_personas(args.user_id, args.batch_size, args.resume))
+
+
+if __name__ == "__main__":
+    main()
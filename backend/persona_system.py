@@ -1,6 +1,6 @@
 """AI Persona System for TASKLY - Contextual AI Helpers"""
 
-from typing import Dict, Tuple
+from typing import Dict, Iterable, List, Tuple, Union
 import re
 
 # Define 8 Specialist AI Personas
@@ -103,29 +103,86 @@ Suggest simple recipes and time-saving techniques. Keep responses appetizing and
     }
 }
 
+# Words, hyphenated words ("self-care") and "$", over lowercased text
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:-[a-z0-9]+)*|\$")
+
+# Simple plural/verb endings a keyword may carry ("exams", "cooked", "running")
+KEYWORD_SUFFIXES = ("s", "es", "d", "ed", "ing")
+
+def _word_forms(keyword: str):
+    yield keyword
+    if keyword[-1].isalnum():
+        for suffix in KEYWORD_SUFFIXES:
+            yield keyword + suffix
+        yield keyword + keyword[-1] + "ing"
+
+def _compile_classifier():
+    """Surface form -> keyword for every persona keyword, plus keyword -> personas.
+
+    Multi-word keywords ("pick up") are matched as adjacent-token phrases.
+    """
+    owners: Dict[str, List[str]] = {}
+    for persona_id, persona in PERSONAS.items():
+        for keyword in persona["keywords"]:
+            owners.setdefault(keyword.lower(), []).append(persona_id)
+    forms: Dict[str, str] = {}
+    phrases: Dict[str, str] = {}
+    for keyword in sorted(owners, key=len):
+        table = phrases if " " in keyword else forms
+        for form in _word_forms(keyword):
+            table.setdefault(form, keyword)
+    for keyword in owners:  # an exact keyword always wins over another keyword's inflection
+        (phrases if " " in keyword else forms)[keyword] = keyword
+    return forms, phrases, owners
+
+_KEYWORD_FORMS, _PHRASE_FORMS, _KEYWORD_OWNERS = _compile_classifier()
+_PERSONA_ORDER = {persona_id: i for i, persona_id in enumerate(PERSONAS)}
+
+def score_personas(text: str) -> List[Tuple[int, str, List[str]]]:
+    """Score every persona in one pass over the words of `text`.
+
+    Keywords match whole words only. Each distinct keyword counts once,
+    weighted by its length (longer keywords are more specific). Returns
+    (score, persona_id, matched keywords) for the personas that matched,
+    best first; ties keep PERSONAS order.
+    """
+    tokens = _TOKEN_RE.findall(text.lower())
+    found: Dict[str, None] = {}
+    for i, token in enumerate(tokens):
+        keyword = _KEYWORD_FORMS.get(token)
+        if keyword:
+            found[keyword] = None
+        elif "-" in token:
+            for part in token.split("-"):
+                if part in _KEYWORD_FORMS:
+                    found[_KEYWORD_FORMS[part]] = None
+        if i:
+            phrase = _PHRASE_FORMS.get(f"{tokens[i - 1]} {token}")
+            if phrase:
+                found[phrase] = None
+
+    matched: Dict[str, List[str]] = {}
+    for keyword in found:
+        for persona_id in _KEYWORD_OWNERS[keyword]:
+            matched.setdefault(persona_id, []).append(keyword)
+    scored = [(sum(len(k) for k in kws), pid, kws) for pid, kws in matched.items()]
+    scored.sort(key=lambda row: (-row[0], _PERSONA_ORDER[row[1]]))
+    return scored
+
 def classify_task_persona(title: str, description: str = "") -> str:
     """Classify a task into a persona category based on keywords.
     Returns the persona ID (e.g., 'financial', 'fitness').
     Default fallback is 'life' (general tasks).
     """
-    text = f"{title} {description}".lower()
-    
-    best_match = "life"  # Default persona
-    best_score = 0
-    
-    for persona_id, persona in PERSONAS.items():
-        score = 0
-        for keyword in persona["keywords"]:
-            # Check for whole word or partial match
-            if keyword in text:
-                # Longer keywords are more specific, give them more weight
-                score += len(keyword)
-        
-        if score > best_score:
-            best_score = score
-            best_match = persona_id
-    
-    return best_match
+    scored = score_personas(f"{title} {description}")
+    return scored[0][1] if scored else "life"
+
+def classify_task_personas(tasks: Iterable[Union[str, Tuple[str, str]]]) -> List[str]:
+    """Batch form of classify_task_persona for titles or (title, description) pairs."""
+    return [
+        classify_task_persona(task) if isinstance(task, str) else classify_task_persona(*task)
+        for task in tasks
+    ]
 
 def get_persona(persona_id: str) -> Dict:
     """Get persona details by ID. Returns 'life' persona as fallback."""
@@ -1,18 +1,33 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, Query
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Optional, Dict, Any, AsyncIterator
 import uuid
 import bcrypt
 import jwt
 from datetime import datetime, timezone, timedelta
 import random
 import asyncio
+import base64
+import copy
+import hashlib
+import json
+
+from cache import TTLCache, SingleFlight
+from text_keys import canonical_title, canonical_key, trigrams, probe_size
+from write_buffer import WriteBehindBuffer
+from llm_gateway import (
+    LLMGateway, LLMScheduler, LLMOverloaded, DEFAULT_BASE_URL, PROVIDERS,
+    PRIORITY_SUGGEST, PRIORITY_BREAKDOWN, PRIORITY_CHAT, PRIORITY_BACKGROUND
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -24,8 +39,40 @@ db = client[os.environ['DB_NAME']]
 
 JWT_SECRET = os.environ.get('JWT_SECRET', 'taskly_default_secret')
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY', '')
+# OpenAI-compatible endpoint (contract in llm_gateway.LLMGateway) for pooled connections and
+# token streaming; probed at startup. Set it empty to send every call through the SDK instead.
+EMERGENT_LLM_BASE_URL = os.environ.get('EMERGENT_LLM_BASE_URL', DEFAULT_BASE_URL)
+# Refuse to start when a provider's replies would not stream token by token
+LLM_REQUIRE_STREAMING = os.environ.get('LLM_REQUIRE_STREAMING', 'false').lower() in ('1', 'true', 'yes')
+LLM_MAX_CONNECTIONS = int(os.environ.get('LLM_MAX_CONNECTIONS', '20'))
+# In-flight LLM calls per provider, and waiters per priority before new calls are shed to fallbacks
+LLM_CONCURRENCY = int(os.environ.get('LLM_CONCURRENCY', '8'))
+LLM_MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', '50'))
 
 AI_MODELS_DISPLAY = {"claude": "Claude", "gpt4o": "GPT-4o", "gemini": "Gemini"}
+MODEL_MAP = {
+    "claude": ("anthropic", "claude-sonnet-4-5-20250929"),
+    "gpt4o": ("openai", "gpt-4o"),
+    "gemini": ("gemini", "gemini-2.5-flash"),
+}
+# Re-send slow /ai/chat prompts to another provider once the primary passes its p95 latency
+AI_CHAT_HEDGING = os.environ.get('AI_CHAT_HEDGING', 'false').lower() in ('1', 'true', 'yes')
+
+# Authenticated-user cache: saves a users round-trip on nearly every request.
+# Entries are refreshed on every write path in this process; the TTL bounds
+# staleness for writes made by other workers.
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '60'))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '10000'))
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# Shared LLM gateway (started/closed with the app); LLM_BASE_URL_<PROVIDER> sets one provider's endpoint
+llm = LLMGateway(
+    api_key=EMERGENT_LLM_KEY,
+    base_url=EMERGENT_LLM_BASE_URL,
+    base_urls={p: os.environ[f"LLM_BASE_URL_{p.upper()}"] for p in PROVIDERS if f"LLM_BASE_URL_{p.upper()}" in os.environ},
+    max_connections=LLM_MAX_CONNECTIONS,
+    scheduler=LLMScheduler(concurrency=LLM_CONCURRENCY, max_queue=LLM_MAX_QUEUE)
+)
 
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
@@ -107,6 +154,14 @@ class PersonaChatRequest(BaseModel):
     persona_id: str
     session_id: Optional[str] = None
 
+class TaskBatchOperation(BaseModel):
+    op: str  # create | update | complete | delete
+    task_id: Optional[str] = None
+    data: Dict[str, Any] = {}
+
+class TaskBatchRequest(BaseModel):
+    operations: List[TaskBatchOperation]
+
 # ─── Auth Helpers ───
 
 def hash_password(password: str) -> str:
@@ -133,15 +188,69 @@ async def get_current_user(request: Request) -> dict:
         raise HTTPException(status_code=401, detail="Not authenticated")
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        user = await db.users.find_one({"user_id": payload["user_id"]}, {"_id": 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        user_id = payload["user_id"]
+        user = user_cache.get(user_id)
+        if user is None:
+            user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
+            if not user:
+                raise HTTPException(status_code=401, detail="User not found")
+            user_cache.set(user_id, user)
+        return dict(user)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+async def etag_response(request: Request, response: Response, user: dict, *parts: Any) -> Optional[Response]:
+    """Conditional GET keyed on the user's `data_version`.
+
+    `parts` carries anything else the payload depends on (e.g. today's date).
+    Returns a 304 response to send when If-None-Match matches, otherwise sets
+    the ETag on `response` and returns None.
+
+    The version is read from Mongo rather than the per-worker user cache, so a
+    write handled by another worker is never answered with a 304. If the cached
+    `user` is behind, it is refreshed in place for the handler to build on.
+    """
+    stored = await db.users.find_one({"user_id": user["user_id"]}, {"_id": 0, "data_version": 1})
+    data_version = (stored or {}).get("data_version", 0)
+    if data_version != user.get("data_version", 0):
+        fresh = await db.users.find_one({"user_id": user["user_id"]}, {"_id": 0})
+        if fresh:
+            user_cache.set(user["user_id"], fresh)
+            user.update(fresh)
+            data_version = fresh.get("data_version", 0)
+    # The user id is hashed in so one account's ETag never validates another's cached body
+    fingerprint = hashlib.md5(
+        f"{user['user_id']}|{request.url.path}?{request.url.query}|{parts}".encode()
+    ).hexdigest()[:12]
+    etag = f'W/"{data_version}-{fingerprint}"'
+    if etag in [t.strip() for t in request.headers.get("If-None-Match", "").split(",")]:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+    return None
+
+async def update_user(user_id: str, update: dict) -> Optional[dict]:
+    """Apply `update` to a user and write the resulting document through to the user cache.
+
+    Every call also bumps the user's `data_version`, which backs the ETags on
+    read routes, so callers must perform their other writes before this one.
+    `update` may be an update document or an aggregation pipeline.
+    """
+    if isinstance(update, list):
+        update = update + [{"$set": {"data_version": {"$add": [{"$ifNull": ["$data_version", 0]}, 1]}}}]
+    else:
+        update = {**update, "$inc": {**update.get("$inc", {}), "data_version": 1}}
+    user = await db.users.find_one_and_update(
+        {"user_id": user_id}, update, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+    )
+    if user:
+        user_cache.set(user_id, user)
+    else:
+        user_cache.pop(user_id)
+    return user
+
 # ─── Auth Routes ───
 
 @api_router.post("/auth/register")
@@ -166,6 +275,7 @@ async def register(data: UserCreate, response: Response):
         "dark_mode": False,
         "ai_preference": "claude",
         "badges": [],
+        "task_stats": empty_task_stats(),
         "last_active": datetime.now(timezone.utc).isoformat(),
         "streak_last_date": "",
         "created_at": datetime.now(timezone.utc).isoformat()
@@ -203,6 +313,7 @@ async def guest_login(response: Response):
         "dark_mode": False,
         "ai_preference": "claude",
         "badges": [],
+        "task_stats": empty_task_stats(),
         "last_active": datetime.now(timezone.utc).isoformat(),
         "streak_last_date": "",
         "is_guest": True,
@@ -235,7 +346,7 @@ async def google_session(request: Request, response: Response):
     existing = await db.users.find_one({"email": google_data["email"]}, {"_id": 0})
     if existing:
         user_id = existing["user_id"]
-        await db.users.update_one({"user_id": user_id}, {"$set": {"name": google_data["name"], "avatar": google_data.get("picture", ""), "last_active": datetime.now(timezone.utc).isoformat()}})
+        await update_user(user_id, {"$set": {"name": google_data["name"], "avatar": google_data.get("picture", ""), "last_active": datetime.now(timezone.utc).isoformat()}})
     else:
         user_id = f"user_{uuid.uuid4().hex[:12]}"
         user_doc = {
@@ -254,6 +365,7 @@ async def google_session(request: Request, response: Response):
             "dark_mode": False,
             "ai_preference": "claude",
             "badges": [],
+            "task_stats": empty_task_stats(),
             "last_active": datetime.now(timezone.utc).isoformat(),
             "streak_last_date": "",
             "created_at": datetime.now(timezone.utc).isoformat()
@@ -270,42 +382,46 @@ async def google_session(request: Request, response: Response):
 async def update_profile(updates: Dict[str, Any], user: dict = Depends(get_current_user)):
     allowed = ["name", "avatar", "mascot", "notification_style", "purpose", "dark_mode", "ai_preference"]
     filtered = {k: v for k, v in updates.items() if k in allowed}
-    if filtered:
-        await db.users.update_one({"user_id": user["user_id"]}, {"$set": filtered})
-    updated = await db.users.find_one({"user_id": user["user_id"]}, {"_id": 0})
+    updated = await update_user(user["user_id"], {"$set": filtered}) if filtered else user
     return {k: v for k, v in updated.items() if k != "password_hash"}
 
 @api_router.put("/user/onboarding")
 async def update_onboarding(data: OnboardingUpdate, user: dict = Depends(get_current_user)):
     updates = {k: v for k, v in data.dict().items() if v is not None}
-    if updates:
-        await db.users.update_one({"user_id": user["user_id"]}, {"$set": updates})
-    updated = await db.users.find_one({"user_id": user["user_id"]}, {"_id": 0})
+    updated = await update_user(user["user_id"], {"$set": updates}) if updates else user
     return {k: v for k, v in updated.items() if k != "password_hash"}
 
 # ─── Task Routes ───
 
-@api_router.post("/tasks")
-async def create_task(task: TaskCreate, user: dict = Depends(get_current_user)):
-    from persona_system import classify_task_persona, get_persona
+def normalize_subtasks(subtasks: List[Dict[str, Any]], keep_ids: bool = False) -> List[dict]:
+    """Subtask documents as stored; every subtask gets a `subtask_id` so toggles can address it."""
+    return [{
+        "subtask_id": (keep_ids and st.get("subtask_id")) or f"st_{uuid.uuid4().hex[:8]}",
+        "title": st.get("title", ""),
+        "completed": st.get("completed", False),
+        "estimated_time": st.get("estimated_time", 15)
+    } for st in subtasks]
+
+def persona_fields(persona_id: str) -> dict:
+    """The persona fields denormalized onto every task"""
+    from persona_system import get_persona
+    persona = get_persona(persona_id)
+    return {
+        "persona_id": persona_id,
+        "persona_name": persona["name"],
+        "persona_emoji": persona["emoji"],
+        "persona_color": persona["color"],
+    }
+
+def build_task_doc(user_id: str, task: TaskCreate) -> dict:
+    from persona_system import classify_task_persona
     
     task_id = f"task_{uuid.uuid4().hex[:12]}"
-    subtasks = []
-    for i, st in enumerate(task.subtasks):
-        subtasks.append({
-            "subtask_id": f"st_{uuid.uuid4().hex[:8]}",
-            "title": st.get("title", ""),
-            "completed": st.get("completed", False),
-            "estimated_time": st.get("estimated_time", 15)
-        })
-    
-    # Auto-detect persona based on task title and description
-    persona_id = classify_task_persona(task.title, task.description)
-    persona = get_persona(persona_id)
+    subtasks = normalize_subtasks(task.subtasks)
     
     task_doc = {
         "task_id": task_id,
-        "user_id": user["user_id"],
+        "user_id": user_id,
         "title": task.title,
         "description": task.description,
         "emoji": task.emoji,
@@ -319,20 +435,92 @@ async def create_task(task: TaskCreate, user: dict = Depends(get_current_user)):
         "completed": False,
         "completed_at": None,
         "xp_earned": 0,
-        "persona_id": persona_id,
-        "persona_name": persona["name"],
-        "persona_emoji": persona["emoji"],
-        "persona_color": persona["color"],
+        # Auto-detect persona based on task title and description
+        **persona_fields(classify_task_persona(task.title, task.description)),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
+    task_doc["updated_at"] = task_doc["created_at"]
+    return task_doc
+
+@api_router.post("/tasks")
+async def create_task(task: TaskCreate, user: dict = Depends(get_current_user)):
+    task_doc = build_task_doc(user["user_id"], task)
     await db.tasks.insert_one(task_doc)
-    logger.info(f"Task created with persona: {persona_id} ({persona['name']})")
+    await touch_user(user, total=1)
+    logger.info(f"Task created with persona: {task_doc['persona_id']} ({task_doc['persona_name']})")
     return {k: v for k, v in task_doc.items() if k != "_id"}
 
+TASK_FIELDS = {
+    "task_id", "user_id", "title", "description", "emoji", "priority", "due_date", "reminder_time",
+    "estimated_time", "category", "tags", "subtasks", "completed", "completed_at", "xp_earned",
+    "persona_id", "persona_name", "persona_emoji", "persona_color", "created_at", "updated_at"
+}
+
+# What list screens render: subtasks are reduced to their `completed` flags,
+# which is all the progress chip needs.
+TASK_SUMMARY_PROJECTION = {
+    "_id": 0, "task_id": 1, "title": 1, "emoji": 1, "priority": 1, "due_date": 1,
+    "completed": 1, "completed_at": 1, "xp_earned": 1, "created_at": 1, "updated_at": 1,
+    "persona_id": 1, "persona_name": 1, "persona_emoji": 1, "persona_color": 1,
+    "subtasks.completed": 1
+}
+
+def task_projection(fields: str) -> dict:
+    """Mongo projection for `fields`: "summary", "full" or a comma-separated list of task fields."""
+    if fields == "summary":
+        return TASK_SUMMARY_PROJECTION
+    if fields == "full":
+        return {"_id": 0}
+    requested = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = requested - TASK_FIELDS
+    if unknown or not requested:
+        raise HTTPException(status_code=400, detail=f"Unknown task fields: {', '.join(sorted(unknown)) or fields}")
+    # Keyset pagination needs the sort keys back
+    return {"_id": 0, "task_id": 1, "created_at": 1, **{f: 1 for f in requested}}
+
+TASKS_PAGE_MAX = 200
+TASK_LIST_SORT = [("created_at", -1), ("task_id", -1)]
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> list:
+    """Every cursor is a (sort key, id) pair of strings; anything else is a 400."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not (isinstance(values, list) and len(values) == 2 and all(isinstance(v, str) for v in values)):
+            raise ValueError(cursor)
+        return values
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @api_router.get("/tasks")
-async def get_tasks(filter: str = "all", user: dict = Depends(get_current_user)):
-    query = {"user_id": user["user_id"]}
+async def get_tasks(
+    request: Request,
+    response: Response,
+    filter: str = "all",
+    limit: Optional[int] = None,
+    after: Optional[str] = None,
+    fields: str = "summary",
+    user: dict = Depends(get_current_user)
+):
+    """List tasks newest first.
+
+    Without `limit` this returns a plain list (capped at 500) as before. With
+    `limit` it returns one keyset page, `{"tasks": [...], "next_cursor": ...}`,
+    walking the (user_id, created_at, task_id) index from the opaque `after`
+    cursor so cost stays flat however deep the client pages.
+
+    `fields` picks the projection applied in Mongo (see task_projection); the
+    default compact summary leaves out descriptions, tags and subtask bodies.
+    """
     now = datetime.now(timezone.utc)
+    not_modified = await etag_response(request, response, user, now.strftime("%Y-%m-%d"))
+    if not_modified:
+        return not_modified
+    query = {"user_id": user["user_id"]}
+    projection = task_projection(fields)
     if filter == "today":
         today_start = now.replace(hour=0, minute=0, second=0).isoformat()
         today_end = now.replace(hour=23, minute=59, second=59).isoformat()
@@ -347,8 +535,76 @@ async def get_tasks(filter: str = "all", user: dict = Depends(get_current_user))
         query["completed"] = True
     elif filter == "active":
         query["completed"] = False
-    tasks = await db.tasks.find(query, {"_id": 0}).sort("created_at", -1).to_list(500)
-    return tasks
+    if limit is None and after is None:
+        return await db.tasks.find(query, projection).sort(TASK_LIST_SORT).to_list(500)
+    limit = max(1, min(limit or TASKS_PAGE_MAX, TASKS_PAGE_MAX))
+    if after:
+        created_at, last_task_id = decode_cursor(after)
+        keyset = {"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "task_id": {"$lt": last_task_id}}
+        ]}
+        query = {"$and": [query, keyset]}
+    tasks = await db.tasks.find(query, projection).sort(TASK_LIST_SORT).limit(limit + 1).to_list(limit + 1)
+    next_cursor = None
+    if len(tasks) > limit:
+        tasks = tasks[:limit]
+        next_cursor = encode_cursor([tasks[-1]["created_at"], tasks[-1]["task_id"]])
+    return {"tasks": tasks, "next_cursor": next_cursor}
+
+TASK_TOMBSTONE_DAYS = int(os.environ.get('TASK_TOMBSTONE_DAYS', '30'))
+# Writes stamp updated_at before they commit, so a sync can race a write that is
+# still in flight. Caught-up cursors stay this far behind "now"; clients upsert
+# by task_id, so the overlap only re-sends a few tasks.
+SYNC_OVERLAP = timedelta(seconds=5)
+SYNC_PAGE_MAX = 500
+
+def task_tombstone(user_id: str, task_id: str, now: datetime) -> dict:
+    return {
+        "user_id": user_id,
+        "task_id": task_id,
+        "deleted_at": now.isoformat(),
+        "expires_at": now + timedelta(days=TASK_TOMBSTONE_DAYS)
+    }
+
+@api_router.get("/tasks/sync")
+async def sync_tasks(since: Optional[str] = None, limit: int = SYNC_PAGE_MAX, user: dict = Depends(get_current_user)):
+    """Tasks created, updated or deleted after the opaque `since` cursor.
+
+    Without `since` this is a full sync. Pages are walked on the
+    (user_id, updated_at, task_id) index; keep calling with the returned
+    cursor while `has_more` is true. `full_resync` means the cursor is older
+    than tombstone retention and the client must drop its copy and start over.
+    """
+    now = datetime.now(timezone.utc)
+    limit = max(1, min(limit, SYNC_PAGE_MAX))
+    query = {"user_id": user["user_id"]}
+    since_ts, since_id = "", ""
+    if since:
+        since_ts, since_id = decode_cursor(since)
+        if since_ts < (now - timedelta(days=TASK_TOMBSTONE_DAYS)).isoformat():
+            return {"tasks": [], "deleted": [], "cursor": None, "has_more": False, "full_resync": True}
+        query["$or"] = [
+            {"updated_at": {"$gt": since_ts}},
+            {"updated_at": since_ts, "task_id": {"$gt": since_id}}
+        ]
+    tasks = await db.tasks.find(query, {"_id": 0}).sort(
+        [("updated_at", 1), ("task_id", 1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    has_more = len(tasks) > limit
+    tasks = tasks[:limit]
+    deleted_query = {"user_id": user["user_id"], "deleted_at": {"$gt": since_ts}}
+    if has_more:
+        cursor = [tasks[-1].get("updated_at", ""), tasks[-1]["task_id"]]
+        deleted_query["deleted_at"]["$lte"] = cursor[0]
+    else:
+        last_seen = tasks[-1].get("updated_at", "") if tasks else since_ts
+        cursor = [min(last_seen, (now - SYNC_OVERLAP).isoformat()), ""]
+    deleted = []
+    if since:
+        tombstones = await db.task_tombstones.find(deleted_query, {"_id": 0, "task_id": 1}).to_list(None)
+        deleted = [t["task_id"] for t in tombstones]
+    return {"tasks": tasks, "deleted": deleted, "cursor": encode_cursor(cursor), "has_more": has_more, "full_resync": False}
 
 @api_router.get("/tasks/{task_id}")
 async def get_task(task_id: str, user: dict = Depends(get_current_user)):
@@ -363,54 +619,257 @@ async def update_task(task_id: str, updates: TaskUpdate, user: dict = Depends(ge
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     update_data = {k: v for k, v in updates.dict().items() if v is not None}
+    if not update_data:
+        return task
+    if "subtasks" in update_data:
+        update_data["subtasks"] = normalize_subtasks(update_data["subtasks"], keep_ids=True)
+    if "title" in update_data or "description" in update_data:
+        from persona_system import classify_task_persona
+        update_data.update(persona_fields(classify_task_persona(
+            update_data.get("title", task["title"]), update_data.get("description", task.get("description") or "")
+        )))
+    now = datetime.now(timezone.utc)
+    update_data["updated_at"] = now.isoformat()
     # Handle completion - award XP
     if "completed" in update_data and update_data["completed"] and not task.get("completed"):
-        xp = calculate_xp(task)
-        update_data["completed_at"] = datetime.now(timezone.utc).isoformat()
-        update_data["xp_earned"] = xp
-        await award_xp(user["user_id"], xp)
-        await update_streak(user["user_id"])
-        await check_badges(user["user_id"])
-        await create_notification(user["user_id"], "achievement", "Task Complete!", f"You earned {xp} XP for completing '{task['title']}'! Keep it up!", user.get("mascot", "owl"))
-    if update_data:
-        await db.tasks.update_one({"task_id": task_id}, {"$set": update_data})
-    updated = await db.tasks.find_one({"task_id": task_id}, {"_id": 0})
+        update_data["completed_at"] = now.isoformat()
+        update_data["xp_earned"] = calculate_xp(task)
+        # Only the request that flips `completed` gets to award XP
+        completed = await db.tasks.find_one_and_update(
+            {"task_id": task_id, "completed": {"$ne": True}},
+            {"$set": update_data},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if completed:
+            await complete_tasks(user, [completed], now)
+            return completed
+        update_data = {k: v for k, v in update_data.items() if k not in ("completed_at", "xp_earned")}
+    elif update_data.get("completed") is False and task.get("completed"):
+        reopened = await db.tasks.find_one_and_update(
+            {"task_id": task_id, "completed": True},
+            {"$set": update_data},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if reopened:
+            today = now.strftime("%Y-%m-%d")
+            await touch_user(user, completed=-1, completed_today=-int((task.get("completed_at") or "").startswith(today)))
+            if task.get("completed_at"):
+                await record_activity(user["user_id"], task["completed_at"][:10], [task], sign=-1)
+            return reopened
+    updated = await db.tasks.find_one_and_update(
+        {"task_id": task_id}, {"$set": update_data}, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+    )
+    await touch_user(user)
     return updated
 
 @api_router.delete("/tasks/{task_id}")
 async def delete_task(task_id: str, user: dict = Depends(get_current_user)):
-    result = await db.tasks.delete_one({"task_id": task_id, "user_id": user["user_id"]})
-    if result.deleted_count == 0:
+    deleted = await db.tasks.find_one_and_delete(
+        {"task_id": task_id, "user_id": user["user_id"]}, projection={"_id": 0, "completed": 1, "completed_at": 1}
+    )
+    if not deleted:
         raise HTTPException(status_code=404, detail="Task not found")
+    now = datetime.now(timezone.utc)
+    await db.task_tombstones.insert_one(task_tombstone(user["user_id"], task_id, now))
+    was_completed = bool(deleted.get("completed"))
+    today = now.strftime("%Y-%m-%d")
+    await touch_user(
+        user,
+        total=-1,
+        completed=-int(was_completed),
+        completed_today=-int(was_completed and (deleted.get("completed_at") or "").startswith(today))
+    )
     return {"message": "Task deleted"}
 
+TASK_BATCH_MAX = 200
+
+@api_router.post("/tasks/batch")
+async def batch_tasks(batch: TaskBatchRequest, user: dict = Depends(get_current_user)):
+    """Apply many create/update/complete/delete operations with one bulk_write.
+
+    Operations are independent (unordered) and each gets its own result entry;
+    a task may appear in at most one operation per batch. Counters, XP,
+    streak, badges and notifications are applied once for the whole batch.
+    """
+    if len(batch.operations) > TASK_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {TASK_BATCH_MAX} operations per batch")
+    user_id = user["user_id"]
+    now = datetime.now(timezone.utc)
+    now_iso = now.isoformat()
+    results = [None] * len(batch.operations)
+    referenced = {op.task_id for op in batch.operations if op.task_id}
+    existing = {}
+    if referenced:
+        found = await db.tasks.find({"user_id": user_id, "task_id": {"$in": list(referenced)}}, {"_id": 0}).to_list(None)
+        existing = {t["task_id"]: t for t in found}
+
+    writes, write_index = [], []
+    created, completing, deleting = [], [], []
+    seen = set()
+    for i, op in enumerate(batch.operations):
+        result = {"index": i, "op": op.op, "task_id": op.task_id}
+        results[i] = result
+        if op.op != "create":
+            if not op.task_id:
+                result.update(status="error", detail="task_id is required")
+                continue
+            if op.task_id in seen:
+                result.update(status="error", detail="task_id appears more than once in this batch")
+                continue
+            seen.add(op.task_id)
+            task = existing.get(op.task_id)
+            if not task:
+                result["status"] = "not_found"
+                continue
+        try:
+            if op.op == "create":
+                doc = build_task_doc(user_id, TaskCreate(**op.data))
+                writes.append(InsertOne(doc))
+                created.append(doc)
+                result.update(task_id=doc["task_id"], status="created", task={k: v for k, v in doc.items() if k != "_id"})
+            elif op.op == "update":
+                update_data = {k: v for k, v in TaskUpdate(**op.data).dict().items() if v is not None}
+                if "completed" in update_data:
+                    raise ValueError("use the complete op to change completion")
+                if not update_data:
+                    raise ValueError("no fields to update")
+                if "subtasks" in update_data:
+                    update_data["subtasks"] = normalize_subtasks(update_data["subtasks"], keep_ids=True)
+                if "title" in update_data or "description" in update_data:
+                    from persona_system import classify_task_persona
+                    update_data.update(persona_fields(classify_task_persona(
+                        update_data.get("title", task["title"]), update_data.get("description", task.get("description") or "")
+                    )))
+                update_data["updated_at"] = now_iso
+                writes.append(UpdateOne({"task_id": op.task_id, "user_id": user_id}, {"$set": update_data}))
+                result["status"] = "updated"
+            elif op.op == "complete":
+                if task.get("completed"):
+                    result["status"] = "already_completed"
+                    continue
+                xp = calculate_xp(task)
+                writes.append(UpdateOne(
+                    {"task_id": op.task_id, "user_id": user_id, "completed": {"$ne": True}},
+                    {"$set": {"completed": True, "completed_at": now_iso, "xp_earned": xp, "updated_at": now_iso}}
+                ))
+                completing.append({**task, "completed": True, "completed_at": now_iso, "xp_earned": xp, "updated_at": now_iso})
+                result["status"] = "completed"
+            elif op.op == "delete":
+                writes.append(DeleteOne({"task_id": op.task_id, "user_id": user_id}))
+                deleting.append(task)
+                result["status"] = "deleted"
+            else:
+                raise ValueError(f"unknown op '{op.op}'")
+        except (ValidationError, ValueError) as e:
+            result.update(status="error", detail=str(e))
+            continue
+        write_index.append(i)
+
+    if not writes:
+        return {"results": results}
+    try:
+        outcome = await db.tasks.bulk_write(writes, ordered=False)
+        counts = (outcome.inserted_count, outcome.modified_count, outcome.deleted_count)
+    except BulkWriteError as e:
+        details = e.details
+        for err in details.get("writeErrors", []):
+            i = write_index[err["index"]]
+            results[i].update(status="error", detail=err.get("errmsg", "write failed"))
+            results[i].pop("task", None)
+        counts = (details.get("nInserted", 0), details.get("nModified", 0), details.get("nRemoved", 0))
+        failed = {results[i]["task_id"] for i in range(len(results)) if results[i]["status"] == "error"}
+        created = [t for t in created if t["task_id"] not in failed]
+        completing = [t for t in completing if t["task_id"] not in failed]
+        deleting = [t for t in deleting if t["task_id"] not in failed]
+
+    expected_modified = sum(1 for r in results if r["status"] in ("updated", "completed"))
+    raced = counts[0] != len(created) or counts[1] != expected_modified or counts[2] != len(deleting)
+    if raced and completing:
+        # A concurrent request got to some of these first; only award what we completed
+        ours = await db.tasks.find(
+            {"user_id": user_id, "task_id": {"$in": [t["task_id"] for t in completing]}, "completed_at": now_iso},
+            {"_id": 0, "task_id": 1}
+        ).to_list(None)
+        ours = {t["task_id"] for t in ours}
+        for r in results:
+            if r["status"] == "completed" and r["task_id"] not in ours:
+                r["status"] = "already_completed"
+        completing = [t for t in completing if t["task_id"] in ours]
+
+    if deleting:
+        await db.task_tombstones.insert_many([task_tombstone(user_id, t["task_id"], now) for t in deleting])
+    today = now.strftime("%Y-%m-%d")
+    if raced:
+        await rebuild_task_stats(user_id)
+        current = user_cache.get(user_id) or user
+    else:
+        deleted_completed = [t for t in deleting if t.get("completed")]
+        current = await touch_user(
+            user,
+            total=len(created) - len(deleting),
+            completed=-len(deleted_completed),
+            completed_today=-sum(1 for t in deleted_completed if (t.get("completed_at") or "").startswith(today))
+        )
+    if completing:
+        # After a recount the counters already include these completions
+        await complete_tasks(current, completing, now, stats_counted=raced)
+    return {"results": results}
+
+def toggled(subtask: Any) -> dict:
+    """Aggregation expression for `subtask` with its `completed` flag flipped."""
+    return {"$let": {
+        "vars": {"st": subtask},
+        "in": {"$mergeObjects": ["$$st", {"completed": {"$not": ["$$st.completed"]}}]}
+    }}
+
 @api_router.put("/tasks/{task_id}/subtask/{subtask_id}")
 async def toggle_subtask(task_id: str, subtask_id: str, user: dict = Depends(get_current_user)):
-    task = await db.tasks.find_one({"task_id": task_id, "user_id": user["user_id"]}, {"_id": 0})
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
-    subtasks = task.get("subtasks", [])
-    found = False
-    for i, st in enumerate(subtasks):
-        # Handle subtasks that may not have subtask_id (generate one if missing)
-        if "subtask_id" not in st:
-            st["subtask_id"] = f"st_{uuid.uuid4().hex[:8]}"
-        if st["subtask_id"] == subtask_id:
-            st["completed"] = not st["completed"]
-            found = True
-            break
-    if not found:
-        # Try matching by index if subtask_id is like "index_0", "index_1", etc.
-        if subtask_id.startswith("index_"):
-            try:
-                idx = int(subtask_id.split("_")[1])
-                if 0 <= idx < len(subtasks):
-                    subtasks[idx]["completed"] = not subtasks[idx]["completed"]
-                    found = True
-            except (ValueError, IndexError):
-                pass
-    await db.tasks.update_one({"task_id": task_id}, {"$set": {"subtasks": subtasks}})
-    return {"subtasks": subtasks}
+    """Flip one subtask's `completed` flag with a single pipeline update.
+
+    The flip happens inside Mongo, so concurrent taps never overwrite each
+    other, and only the changed subtask comes back. `index_<n>` ids address
+    subtasks by position for clients that never received ids.
+    """
+    query = {"task_id": task_id, "user_id": user["user_id"]}
+    now_iso = datetime.now(timezone.utc).isoformat()
+    idx = None
+    if subtask_id.startswith("index_"):
+        try:
+            idx = int(subtask_id.split("_", 1)[1])
+        except ValueError:
+            idx = None
+    if idx is not None and idx >= 0:
+        query[f"subtasks.{idx}"] = {"$exists": True}
+        subtasks = {"$map": {
+            "input": {"$range": [0, {"$size": "$subtasks"}]},
+            "as": "i",
+            "in": {"$cond": [
+                {"$eq": ["$$i", idx]},
+                toggled({"$arrayElemAt": ["$subtasks", "$$i"]}),
+                {"$arrayElemAt": ["$subtasks", "$$i"]}
+            ]}
+        }}
+        projection = {"_id": 0, "subtasks": {"$slice": [idx, 1]}}
+    else:
+        query["subtasks.subtask_id"] = subtask_id
+        subtasks = {"$map": {
+            "input": "$subtasks",
+            "as": "st",
+            "in": {"$cond": [{"$eq": ["$$st.subtask_id", subtask_id]}, toggled("$$st"), "$$st"]}
+        }}
+        projection = {"_id": 0, "subtasks": {"$elemMatch": {"subtask_id": subtask_id}}}
+    updated = await db.tasks.find_one_and_update(
+        query,
+        [{"$set": {"subtasks": subtasks, "updated_at": now_iso}}],
+        projection=projection,
+        return_document=ReturnDocument.AFTER
+    )
+    if not updated or not updated.get("subtasks"):
+        raise HTTPException(status_code=404, detail="Task or subtask not found")
+    await touch_user(user)
+    return {"subtask": updated["subtasks"][0]}
 
 # ─── Gamification Helpers ───
 
@@ -429,26 +888,97 @@ def calculate_xp(task: dict) -> int:
             pass
     return xp
 
-async def award_xp(user_id: str, xp: int):
-    user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
-    new_xp = user.get("xp", 0) + xp
-    new_level = max(1, new_xp // 100 + 1)
-    await db.users.update_one({"user_id": user_id}, {"$set": {"xp": new_xp, "level": new_level}})
+def empty_task_stats() -> dict:
+    return {"total": 0, "completed": 0, "completed_today": 0, "today": ""}
 
-async def update_streak(user_id: str):
-    user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+def read_task_stats(stats: dict, now: datetime) -> dict:
+    """Materialized counters as of `now`: `completed_today` resets when the day rolls over."""
+    today = now.strftime("%Y-%m-%d")
+    total = stats.get("total", 0)
+    completed = stats.get("completed", 0)
+    return {
+        "total": total,
+        "completed": completed,
+        "active": max(0, total - completed),
+        "completed_today": stats.get("completed_today", 0) if stats.get("today") == today else 0,
+        "today": today,
+    }
+
+async def rebuild_task_stats(user_id: str) -> dict:
+    """Recount a user's tasks and overwrite their materialized `task_stats`."""
+    now = datetime.now(timezone.utc)
+    today = now.strftime("%Y-%m-%d")
+    rows = await db.tasks.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$group": {
+            "_id": None,
+            "total": {"$sum": 1},
+            "completed": {"$sum": {"$cond": [{"$eq": ["$completed", True]}, 1, 0]}},
+            "completed_today": {"$sum": {"$cond": [
+                {"$and": [{"$eq": ["$completed", True]}, {"$gte": ["$completed_at", today]}]}, 1, 0
+            ]}}
+        }}
+    ]).to_list(1)
+    stats = empty_task_stats()
+    if rows:
+        stats.update({k: rows[0][k] for k in ("total", "completed", "completed_today")})
+    stats["today"] = today
+    await update_user(user_id, {"$set": {"task_stats": stats}})
+    return read_task_stats(stats, now)
+
+async def get_task_stats(user: dict) -> dict:
+    """O(1) task counters for `user`, rebuilt once for accounts that predate them."""
+    if "task_stats" in user:
+        return read_task_stats(user["task_stats"], datetime.now(timezone.utc))
+    return await rebuild_task_stats(user["user_id"])
+
+async def touch_user(user: dict, **task_stat_deltas: int) -> dict:
+    """Record a change to the user's data: bump `data_version` and apply task counter deltas.
+
+    Accounts that predate materialized counters are recounted instead; the
+    recount already includes the change that was just written. Returns the
+    updated user document.
+    """
+    if "task_stats" not in user:
+        await rebuild_task_stats(user["user_id"])
+    else:
+        inc = {f"task_stats.{k}": v for k, v in task_stat_deltas.items() if v}
+        await update_user(user["user_id"], {"$inc": inc})
+    return user_cache.get(user["user_id"]) or user
+
+async def record_activity(user_id: str, date: str, tasks: List[dict], sign: int = 1):
+    """Fold completions of `tasks` on `date` into the `daily_activity` rollup.
+
+    Reopening a task passes sign=-1. XP is not taken back on reopen, so the
+    rollup keeps it too; deleting a task leaves its history untouched.
+    """
+    if not tasks:
+        return
+    inc = {
+        "completed": sign * len(tasks),
+        "minutes": sign * sum(t.get("estimated_time") or 0 for t in tasks),
+    }
+    if sign > 0:
+        inc["xp"] = sum(t.get("xp_earned", 0) for t in tasks)
+    await db.daily_activity.update_one({"user_id": user_id, "date": date}, {"$inc": inc}, upsert=True)
+
+def level_for_xp(xp: int) -> int:
+    return max(1, xp // 100 + 1)
+
+def level_expr(xp: Any) -> dict:
+    """level_for_xp as an aggregation expression, for pipeline updates"""
+    return {"$max": [1, {"$add": [{"$floor": {"$divide": [xp, 100]}}, 1]}]}
+
+def next_streak(user: dict, now: datetime) -> tuple:
+    """Return (streak, streak_last_date) after activity at `now`."""
+    today = now.strftime("%Y-%m-%d")
     last_date = user.get("streak_last_date", "")
     if last_date == today:
-        return
-    yesterday = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d")
+        return user.get("streak", 0), today
+    yesterday = (now - timedelta(days=1)).strftime("%Y-%m-%d")
     if last_date == yesterday:
-        new_streak = user.get("streak", 0) + 1
-    elif last_date == "":
-        new_streak = 1
-    else:
-        new_streak = 1
-    await db.users.update_one({"user_id": user_id}, {"$set": {"streak": new_streak, "streak_last_date": today}})
+        return user.get("streak", 0) + 1, today
+    return 1, today
 
 BADGE_DEFINITIONS = [
     {"badge_type": "early_bird", "name": "Early Bird", "description": "Complete a task before 9am", "icon": "🌅"},
@@ -464,11 +994,10 @@ BADGE_DEFINITIONS = [
     {"badge_type": "zero_inbox", "name": "Zero Inbox", "description": "Clear all tasks in a day", "icon": "🏆"},
 ]
 
-async def check_badges(user_id: str):
-    user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
+def evaluate_badges(user: dict, completed_count: int, active_count: int, now: datetime, recent_task: Optional[dict] = None) -> List[dict]:
+    """Return badge documents newly earned by `user`, computed purely in memory."""
     existing_badges = set(b.get("badge_type") for b in user.get("badges", []))
     new_badges = []
-    completed_count = await db.tasks.count_documents({"user_id": user_id, "completed": True})
     if "first_task" not in existing_badges and completed_count >= 1:
         new_badges.append("first_task")
     if "task_10" not in existing_badges and completed_count >= 10:
@@ -479,67 +1008,265 @@ async def check_badges(user_id: str):
         new_badges.append("streak_3")
     if "consistency_king" not in existing_badges and user.get("streak", 0) >= 7:
         new_badges.append("consistency_king")
-    now = datetime.now(timezone.utc)
     if "early_bird" not in existing_badges and now.hour < 9:
         new_badges.append("early_bird")
     if "night_owl" not in existing_badges and now.hour >= 21:
         new_badges.append("night_owl")
     # Speed Runner - check if completed faster than estimate
-    recent_task = await db.tasks.find_one({"user_id": user_id, "completed": True}, {"_id": 0}, sort=[("completed_at", -1)])
     if recent_task and "speed_runner" not in existing_badges:
         if recent_task.get("estimated_time", 0) > 0:
             new_badges.append("speed_runner")
     # Zero Inbox - all tasks for today completed
-    if "zero_inbox" not in existing_badges:
-        active_today = await db.tasks.count_documents({"user_id": user_id, "completed": False})
-        if active_today == 0 and completed_count > 0:
-            new_badges.append("zero_inbox")
+    if "zero_inbox" not in existing_badges and active_count == 0 and completed_count > 0:
+        new_badges.append("zero_inbox")
+    badges = []
     for badge_type in new_badges:
         badge_def = next((b for b in BADGE_DEFINITIONS if b["badge_type"] == badge_type), None)
         if badge_def:
-            badge = {**badge_def, "earned_at": datetime.now(timezone.utc).isoformat()}
-            await db.users.update_one({"user_id": user_id}, {"$push": {"badges": badge}})
-            await create_notification(user_id, "badge", f"Badge Unlocked: {badge_def['name']}!", f"{badge_def['icon']} {badge_def['description']}", user.get("mascot", "owl"))
+            badges.append({**badge_def, "earned_at": now.isoformat()})
+    return badges
+
+def badge_notifications(badges: List[dict]) -> List[tuple]:
+    return [("badge", f"Badge Unlocked: {b['name']}!", f"{b['icon']} {b['description']}") for b in badges]
+
+COMPLETION_MAX_ATTEMPTS = 5
+
+async def complete_tasks(user: dict, tasks: List[dict], now: datetime, stats_counted: bool = False) -> dict:
+    """Apply XP, level, streak and badge effects for freshly completed `tasks`.
+
+    Everything is computed in memory from the user document the request already
+    holds, then committed with one conditional find_one_and_update. The filter
+    pins the xp/streak values and counter day the computation was based on, so
+    a concurrent completion makes the commit miss and we recompute from a
+    fresh read. Counters are only ever moved with $inc. Notifications are
+    written after the commit, only for badges it pushed, and data_version is
+    bumped last. `stats_counted` means the task counters already include `tasks`.
+    """
+    user_id = user["user_id"]
+    xp_gained = sum(t.get("xp_earned", 0) for t in tasks)
+    current = user
+    if "task_stats" not in current:
+        # The recount already includes `tasks`, which were marked completed before we got here
+        await rebuild_task_stats(user_id)
+        current = user_cache.get(user_id) or await db.users.find_one({"user_id": user_id}, {"_id": 0})
+        stats_counted = True
+    stats_delta = 0 if stats_counted else len(tasks)
+    mascot = current.get("mascot", "owl")
+    if len(tasks) == 1:
+        notifications = [
+            ("achievement", "Task Complete!", f"You earned {xp_gained} XP for completing '{tasks[0]['title']}'! Keep it up!")
+        ]
+    else:
+        notifications = [
+            ("achievement", f"{len(tasks)} Tasks Complete!", f"You earned {xp_gained} XP for completing {len(tasks)} tasks! Keep it up!")
+        ]
+    for _ in range(COMPLETION_MAX_ATTEMPTS):
+        stats = read_task_stats(current.get("task_stats", {}), now)
+        completed_count = stats["completed"] + stats_delta
+        active_count = max(0, stats["total"] - completed_count)
+        streak, streak_date = next_streak(current, now)
+        new_xp = current.get("xp", 0) + xp_gained
+        projected = {**current, "xp": new_xp, "streak": streak}
+        new_badges = evaluate_badges(projected, completed_count, active_count, now, tasks[-1])
+        update = {
+            "$inc": {"xp": xp_gained, "task_stats.completed": stats_delta},
+            "$set": {
+                "level": level_for_xp(new_xp),
+                "streak": streak,
+                "streak_last_date": streak_date
+            }
+        }
+        query = {
+            "user_id": user_id,
+            "xp": current.get("xp", 0),
+            "streak_last_date": current.get("streak_last_date", "")
+        }
+        # completed_today is also adjusted with $inc by reopen/delete: increment it
+        # while the stored day is still today, and reset it on rollover. Pinning the
+        # stored day makes a concurrent rollover miss and recompute.
+        stored_day = current.get("task_stats", {}).get("today")
+        query["task_stats.today"] = stored_day
+        if stored_day == stats["today"]:
+            update["$inc"]["task_stats.completed_today"] = stats_delta
+        else:
+            update["$set"]["task_stats.completed_today"] = stats_delta
+            update["$set"]["task_stats.today"] = stats["today"]
+        if new_badges:
+            update["$push"] = {"badges": {"$each": new_badges}}
+            query["badges.badge_type"] = {"$nin": [b["badge_type"] for b in new_badges]}
+        committed = await db.users.find_one_and_update(
+            query, update, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+        )
+        if committed:
+            # Only badges this commit actually pushed get a notification
+            notifications += badge_notifications(new_badges)
+            break
+        current = await db.users.find_one({"user_id": user_id}, {"_id": 0})
+        if not current:
+            user_cache.pop(user_id)
+            return user
+    else:
+        # The tasks are already stored as completed: apply XP, streak and
+        # counters unconditionally, leaving badges for a later evaluation.
+        logger.warning(f"Completion commit for {user_id} hit {COMPLETION_MAX_ATTEMPTS} conflicts; applying unconditionally")
+        committed = await db.users.find_one_and_update(
+            {"user_id": user_id}, completion_fallback_update(xp_gained, stats_delta, now),
+            projection={"_id": 0}, return_document=ReturnDocument.AFTER
+        )
+        if not committed:
+            user_cache.pop(user_id)
+            return user
+    await create_notifications(user_id, notifications, mascot)
+    await record_activity(user_id, now.strftime("%Y-%m-%d"), tasks)
+    # Bump data_version last: anyone who sees the new version (ETags) also sees
+    # the notifications and activity it stands for.
+    return await update_user(user_id, {}) or committed
+
+def completion_fallback_update(xp_gained: int, stats_delta: int, now: datetime) -> list:
+    """complete_tasks' effects as one pipeline update computed from the stored document"""
+    today = now.strftime("%Y-%m-%d")
+    yesterday = (now - timedelta(days=1)).strftime("%Y-%m-%d")
+    xp = {"$add": [{"$ifNull": ["$xp", 0]}, xp_gained]}
+    streak = {"$ifNull": ["$streak", 0]}
+    return [{"$set": {
+        "xp": xp,
+        "level": level_expr(xp),
+        "streak": {"$switch": {
+            "branches": [
+                {"case": {"$eq": ["$streak_last_date", today]}, "then": streak},
+                {"case": {"$eq": ["$streak_last_date", yesterday]}, "then": {"$add": [streak, 1]}},
+            ],
+            "default": 1
+        }},
+        "streak_last_date": today,
+        "task_stats.completed": {"$add": [{"$ifNull": ["$task_stats.completed", 0]}, stats_delta]},
+        "task_stats.completed_today": {"$cond": [
+            {"$eq": ["$task_stats.today", today]},
+            {"$add": [{"$ifNull": ["$task_stats.completed_today", 0]}, stats_delta]},
+            stats_delta
+        ]},
+        "task_stats.today": today,
+    }}]
+
+async def check_badges(user: dict):
+    """Award any badges `user` now qualifies for (used by the developer tools)."""
+    user_id = user["user_id"]
+    stats = await get_task_stats(user)
+    recent_task = await db.tasks.find_one({"user_id": user_id, "completed": True}, {"_id": 0}, sort=[("completed_at", -1)])
+    new_badges = evaluate_badges(user, stats["completed"], stats["active"], datetime.now(timezone.utc), recent_task)
+    if not new_badges:
+        return user
+    return await push_badges(user_id, new_badges, user.get("mascot", "owl")) or user
+
+async def push_badges(user_id: str, badges: List[dict], mascot: str) -> Optional[dict]:
+    """Add `badges` unless the user already holds one of them, notifying only if they were added.
+
+    Returns the updated user, or None when nothing was pushed.
+    """
+    pushed = await db.users.find_one_and_update(
+        {"user_id": user_id, "badges.badge_type": {"$nin": [b["badge_type"] for b in badges]}},
+        {"$push": {"badges": {"$each": badges}}},
+        projection={"_id": 0, "user_id": 1}
+    )
+    if not pushed:
+        return None
+    await create_notifications(user_id, badge_notifications(badges), mascot)
+    # Bump data_version only once the notifications exist
+    return await update_user(user_id, {})
 
 # ─── Gamification Routes ───
 
+ACTIVITY_WINDOWS = (7, 30, 90, 365)
+
+async def completion_activity(user_id: str, days: int) -> dict:
+    """Per-day completion histogram for the last `days` days plus window totals, in one aggregation.
+
+    Days are keyed by the `YYYY-MM-DD` prefix of the ISO `completed_at` string (UTC).
+    """
+    now = datetime.now(timezone.utc)
+    window_start = (now - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    rows = await db.tasks.aggregate([
+        {"$match": {"user_id": user_id, "completed": True, "completed_at": {"$gte": window_start}}},
+        {"$facet": {
+            "by_day": [
+                {"$group": {"_id": {"$substrBytes": ["$completed_at", 0, 10]}, "count": {"$sum": 1}}}
+            ],
+            "totals": [
+                {"$group": {"_id": None, "completed": {"$sum": 1}, "xp": {"$sum": "$xp_earned"}}}
+            ]
+        }}
+    ]).to_list(1)
+    facets = rows[0] if rows else {"by_day": [], "totals": []}
+    counts = {row["_id"]: row["count"] for row in facets["by_day"]}
+    totals = facets["totals"][0] if facets["totals"] else {"completed": 0, "xp": 0}
+    activity = []
+    for i in range(days):
+        day = now - timedelta(days=days - 1 - i)
+        date = day.strftime("%Y-%m-%d")
+        activity.append({"date": date, "day": day.strftime("%a"), "count": counts.get(date, 0)})
+    return {"activity": activity, "completed": totals["completed"], "xp": totals["xp"]}
+
 @api_router.get("/gamification/stats")
-async def get_gamification_stats(user: dict = Depends(get_current_user)):
-    completed_today = await db.tasks.count_documents({
-        "user_id": user["user_id"],
-        "completed": True,
-        "completed_at": {"$gte": datetime.now(timezone.utc).replace(hour=0, minute=0, second=0).isoformat()}
-    })
-    total_completed = await db.tasks.count_documents({"user_id": user["user_id"], "completed": True})
-    total_tasks = await db.tasks.count_documents({"user_id": user["user_id"]})
-    # Weekly activity
-    week_activity = []
-    for i in range(7):
-        day = datetime.now(timezone.utc) - timedelta(days=6-i)
-        day_start = day.replace(hour=0, minute=0, second=0).isoformat()
-        day_end = day.replace(hour=23, minute=59, second=59).isoformat()
-        count = await db.tasks.count_documents({
-            "user_id": user["user_id"],
-            "completed": True,
-            "completed_at": {"$gte": day_start, "$lte": day_end}
-        })
-        week_activity.append({"date": day.strftime("%Y-%m-%d"), "day": day.strftime("%a"), "count": count})
+async def get_gamification_stats(request: Request, response: Response, days: int = 7, user: dict = Depends(get_current_user)):
+    if days not in ACTIVITY_WINDOWS:
+        raise HTTPException(status_code=400, detail=f"days must be one of {list(ACTIVITY_WINDOWS)}")
+    not_modified = await etag_response(request, response, user, datetime.now(timezone.utc).strftime("%Y-%m-%d"))
+    if not_modified:
+        return not_modified
+    stats = await get_task_stats(user)
+    window = await completion_activity(user["user_id"], days)
     return {
         "xp": user.get("xp", 0),
         "level": user.get("level", 1),
         "streak": user.get("streak", 0),
         "badges": user.get("badges", []),
-        "completed_today": completed_today,
-        "total_completed": total_completed,
-        "total_tasks": total_tasks,
-        "week_activity": week_activity,
+        "completed_today": stats["completed_today"],
+        "total_completed": stats["completed"],
+        "total_tasks": stats["total"],
+        "week_activity": window["activity"][-7:],
+        "activity_days": days,
+        "activity": window["activity"],
+        "window_completed": window["completed"],
+        "window_xp": window["xp"],
         "all_badges": BADGE_DEFINITIONS
     }
 
+HISTORY_MAX_DAYS = 731
+
+@api_router.get("/gamification/history")
+async def get_activity_history(
+    from_date: Optional[str] = Query(None, alias="from"),
+    to_date: Optional[str] = Query(None, alias="to"),
+    user: dict = Depends(get_current_user)
+):
+    """Daily completion rollup for heatmaps. Only days with activity are returned."""
+    try:
+        end = datetime.strptime(to_date, "%Y-%m-%d") if to_date else datetime.now(timezone.utc).replace(tzinfo=None)
+        start = datetime.strptime(from_date, "%Y-%m-%d") if from_date else end - timedelta(days=364)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="from/to must be YYYY-MM-DD dates")
+    if start > end:
+        raise HTTPException(status_code=400, detail="from must not be after to")
+    if (end - start).days >= HISTORY_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Range is limited to {HISTORY_MAX_DAYS} days")
+    start_str, end_str = start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+    days = await db.daily_activity.find(
+        {"user_id": user["user_id"], "date": {"$gte": start_str, "$lte": end_str}},
+        {"_id": 0, "user_id": 0}
+    ).sort("date", 1).to_list(HISTORY_MAX_DAYS)
+    return {
+        "from": start_str,
+        "to": end_str,
+        "days": days,
+        "total_completed": sum(d.get("completed", 0) for d in days),
+        "total_xp": sum(d.get("xp", 0) for d in days),
+        "total_minutes": sum(d.get("minutes", 0) for d in days)
+    }
+
 # ─── Notification Helpers ───
 
-async def create_notification(user_id: str, notif_type: str, title: str, message: str, character: str = "owl"):
-    notif = {
+def build_notification(user_id: str, notif_type: str, title: str, message: str, character: str = "owl") -> dict:
+    return {
         "notification_id": f"notif_{uuid.uuid4().hex[:12]}",
         "user_id": user_id,
         "type": notif_type,
@@ -549,9 +1276,19 @@ async def create_notification(user_id: str, notif_type: str, title: str, message
         "read": False,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
+
+async def create_notification(user_id: str, notif_type: str, title: str, message: str, character: str = "owl"):
+    notif = build_notification(user_id, notif_type, title, message, character)
     await db.notifications.insert_one(notif)
     return notif
 
+async def create_notifications(user_id: str, items: List[tuple], character: str = "owl") -> List[dict]:
+    """Insert several (type, title, message) notifications in one round-trip."""
+    notifs = [build_notification(user_id, notif_type, title, message, character) for notif_type, title, message in items]
+    if notifs:
+        await db.notifications.insert_many(notifs)
+    return notifs
+
 # ─── Notification Routes ───
 
 @api_router.get("/notifications")
@@ -561,43 +1298,217 @@ async def get_notifications(user: dict = Depends(get_current_user)):
 
 @api_router.put("/notifications/{notification_id}/read")
 async def mark_notification_read(notification_id: str, user: dict = Depends(get_current_user)):
-    await db.notifications.update_one({"notification_id": notification_id, "user_id": user["user_id"]}, {"$set": {"read": True}})
+    result = await db.notifications.update_one({"notification_id": notification_id, "user_id": user["user_id"]}, {"$set": {"read": True}})
+    if result.modified_count:
+        await touch_user(user)
     return {"message": "Marked as read"}
 
 @api_router.post("/notifications/mark-all-read")
 async def mark_all_read(user: dict = Depends(get_current_user)):
-    await db.notifications.update_many({"user_id": user["user_id"], "read": False}, {"$set": {"read": True}})
+    result = await db.notifications.update_many({"user_id": user["user_id"], "read": False}, {"$set": {"read": True}})
+    if result.modified_count:
+        await touch_user(user)
     return {"message": "All marked as read"}
 
 @api_router.get("/notifications/unread-count")
-async def unread_count(user: dict = Depends(get_current_user)):
+async def unread_count(request: Request, response: Response, user: dict = Depends(get_current_user)):
+    not_modified = await etag_response(request, response, user)
+    if not_modified:
+        return not_modified
     count = await db.notifications.count_documents({"user_id": user["user_id"], "read": False})
     return {"count": count}
 
+# ─── AI Result Cache ───
+
+# Two tiers per kind of result: a per-worker LRU in front of a shared Mongo collection
+AI_CACHE_TTL = int(os.environ.get('AI_CACHE_TTL', str(7 * 24 * 3600)))
+AI_MEMORY_CACHE_TTL = float(os.environ.get('AI_MEMORY_CACHE_TTL', '3600'))
+AI_MEMORY_CACHE_SIZE = int(os.environ.get('AI_MEMORY_CACHE_SIZE', '2048'))
+AI_CACHE_COLLECTIONS = {"suggest": db.ai_cache, "breakdown": db.ai_breakdown_cache}
+ai_memory_cache = TTLCache(
+    maxsize=AI_MEMORY_CACHE_SIZE,
+    ttl=min(AI_MEMORY_CACHE_TTL, AI_CACHE_TTL),
+    sizeof=lambda value: len(json.dumps(value))
+)
+ai_mongo_counters = {kind: {"hits": 0, "fuzzy_hits": 0, "misses": 0} for kind in AI_CACHE_COLLECTIONS}
+# Near-duplicate titles (trigram Jaccard over canonical titles) reuse a cached result; 1.0 disables
+AI_FUZZY_THRESHOLD = float(os.environ.get('AI_FUZZY_THRESHOLD', '0.8'))
+# Every probed candidate is scored; a lookup over this budget counts as a miss
+AI_FUZZY_MAX_MS = int(os.environ.get('AI_FUZZY_MAX_MS', '100'))
+
+async def ai_cache_get(kind: str, title_hash: str, canonical: Optional[str] = None) -> Optional[dict]:
+    """Look a result up in memory, then Mongo, then by similarity (warming memory on a Mongo hit)"""
+    result = ai_memory_cache.get((kind, title_hash))
+    if result is not None:
+        return result
+    collection = AI_CACHE_COLLECTIONS[kind]
+    counters = ai_mongo_counters[kind]
+    cached = await collection.find_one({"title_hash": title_hash}, {"_id": 0, "result": 1})
+    if cached:
+        counters["hits"] += 1
+    elif canonical and AI_FUZZY_THRESHOLD < 1:
+        cached = await ai_cache_nearest(collection, canonical)
+        if cached:
+            counters["fuzzy_hits"] += 1
+            logger.info(f"AI CACHE: {kind} '{canonical}' matched '{cached['canonical']}'")
+    if not cached:
+        counters["misses"] += 1
+        return None
+    result = cached.get("result", {})
+    ai_memory_cache.set((kind, title_hash), result)
+    return result
+
+async def ai_cache_nearest(collection, canonical: str) -> Optional[dict]:
+    """Most similar cached title with trigram Jaccard >= AI_FUZZY_THRESHOLD, if any.
+
+    All entries sharing a probe trigram are scored before ranking, so none is
+    skipped; the scan is bounded by AI_FUZZY_MAX_MS instead of a candidate count.
+    """
+    grams = trigrams(canonical)
+    probe = grams[:probe_size(len(grams), AI_FUZZY_THRESHOLD)]
+    pipeline = [
+        {"$match": {"trigrams": {"$in": probe}}},
+        {"$project": {
+            "_id": 0, "canonical": 1, "result": 1,
+            "overlap": {"$size": {"$setIntersection": ["$trigrams", grams]}},
+            "size": {"$size": "$trigrams"}
+        }},
+        {"$set": {"similarity": {"$divide": [
+            "$overlap", {"$subtract": [{"$add": ["$size", len(grams)]}, "$overlap"]}
+        ]}}},
+        {"$match": {"similarity": {"$gte": AI_FUZZY_THRESHOLD}}},
+        {"$sort": {"similarity": -1}},
+        {"$limit": 1}
+    ]
+    try:
+        candidates = await collection.aggregate(pipeline, maxTimeMS=AI_FUZZY_MAX_MS).to_list(1)
+    except OperationFailure as e:
+        if e.code != 50:  # MaxTimeMSExpired
+            raise
+        logger.warning(f"AI CACHE: similarity lookup for '{canonical}' exceeded {AI_FUZZY_MAX_MS}ms")
+        return None
+    return candidates[0] if candidates else None
+
+async def ai_cache_put(kind: str, title_hash: str, result: dict, canonical: Optional[str] = None):
+    ai_memory_cache.set((kind, title_hash), result)
+    doc = {"title_hash": title_hash, "result": result, "created_at": datetime.now(timezone.utc)}
+    if canonical:
+        doc.update({"canonical": canonical, "trigrams": trigrams(canonical)})
+    await AI_CACHE_COLLECTIONS[kind].update_one({"title_hash": title_hash}, {"$set": doc}, upsert=True)
+
+def ai_cache_stats() -> dict:
+    mongo = {}
+    for kind, counters in ai_mongo_counters.items():
+        hits = counters["hits"] + counters["fuzzy_hits"]
+        lookups = hits + counters["misses"]
+        mongo[kind] = {**counters, "hit_rate": round(hits / lookups, 4) if lookups else 0.0}
+    return {"memory": ai_memory_cache.stats(), "mongo": mongo, "ttl": AI_CACHE_TTL}
+
 # ─── AI Routes ───
 
+AI_SUGGEST_FALLBACK = {"emoji": "📝", "priority": "medium", "estimated_time": 30, "category": "general", "tags": [], "suggested_due": None, "suggested_reminder": None}
+# Cross-worker dedup of uncached suggestions; in-process coalescing is always on
+AI_SUGGEST_LEASE = os.environ.get('AI_SUGGEST_LEASE', 'false').lower() in ('1', 'true', 'yes')
+AI_LEASE_SECONDS = 10.0
+AI_LEASE_POLL = 0.25
+suggest_flight = SingleFlight()
+# Keyword-rule suggestions at or above this confidence skip the LLM round-trip
+AI_RULES_CONFIDENCE = float(os.environ.get('AI_RULES_CONFIDENCE', '0.6'))
+# Refine confident rule suggestions with the LLM in the background so the cache converges on LLM quality
+AI_RULES_REFINE = os.environ.get('AI_RULES_REFINE', 'true').lower() in ('1', 'true', 'yes')
+# Confidence 1.0 means the keyword weight reached STRONG_SCORE with no competing persona: no refinement
+AI_RULES_FINAL_CONFIDENCE = float(os.environ.get('AI_RULES_FINAL_CONFIDENCE', '1.0'))
+# At most one background refinement per title key per interval, per worker
+AI_RULES_REFINE_INTERVAL = float(os.environ.get('AI_RULES_REFINE_INTERVAL', '3600'))
+rules_refined = TTLCache(maxsize=10000, ttl=AI_RULES_REFINE_INTERVAL)
+background_tasks = set()
+
+def spawn(coro):
+    """Fire-and-forget a coroutine, holding a reference until it finishes"""
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def acquire_ai_lease(key: str) -> Optional[str]:
+    """Claim `key` in `ai_leases` for AI_LEASE_SECONDS. Returns a token, or None if another worker holds it."""
+    now = datetime.now(timezone.utc)
+    token = uuid.uuid4().hex
+    try:
+        await db.ai_leases.update_one(
+            {"_id": key, "expires_at": {"$lte": now}},
+            {"$set": {"token": token, "expires_at": now + timedelta(seconds=AI_LEASE_SECONDS)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return None
+    return token
+
+async def wait_for_ai_cache(title_hash: str, lease_key: str) -> Optional[dict]:
+    """Poll for the result a lease holder on another worker is computing."""
+    deadline = asyncio.get_running_loop().time() + AI_LEASE_SECONDS
+    while asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(AI_LEASE_POLL)
+        cached = await db.ai_cache.find_one({"title_hash": title_hash}, {"_id": 0, "result": 1})
+        if cached:
+            ai_memory_cache.set(("suggest", title_hash), cached.get("result", {}))
+            return cached.get("result", {})
+        if not await db.ai_leases.find_one({"_id": lease_key}, {"_id": 1}):
+            return None  # holder gave up without caching (timeout/error)
+    return None
+
+async def suggest_uncached(title: str, title_hash: str, canonical: str, user_id: str,
+                           priority: int = PRIORITY_SUGGEST) -> dict:
+    """One LLM call per title per worker; optionally one per title across workers."""
+    if not AI_SUGGEST_LEASE:
+        return await llm_suggest(title, title_hash, canonical, user_id, priority)
+    lease_key = f"suggest:{title_hash}"
+    token = await acquire_ai_lease(lease_key)
+    if token is None:
+        result = await wait_for_ai_cache(title_hash, lease_key)
+        if result is not None:
+            logger.info(f"AI SUGGEST: Shared result from another worker for '{title}'")
+            return result
+        return await llm_suggest(title, title_hash, canonical, user_id, priority)
+    try:
+        return await llm_suggest(title, title_hash, canonical, user_id, priority)
+    finally:
+        await db.ai_leases.delete_one({"_id": lease_key, "token": token})
+
 @api_router.post("/ai/suggest")
 async def ai_suggest_task(data: AISuggestRequest, user: dict = Depends(get_current_user)):
     """AI auto-suggests with caching - includes due date and reminder time suggestions"""
-    import hashlib
-    title_hash = hashlib.md5(data.title.lower().strip().encode()).hexdigest()
+    # "Study for the math exam!" and "studying for math exams" share one key
+    canonical = canonical_title(data.title)
+    title_hash = canonical_key(canonical)
 
     # Check cache first
-    cached = await db.ai_cache.find_one({"title_hash": title_hash}, {"_id": 0})
-    if cached:
+    cached = await ai_cache_get("suggest", title_hash, canonical)
+    if cached is not None:
         logger.info(f"AI SUGGEST: Cache hit for '{data.title}'")
-        return cached.get("result", {})
-
-    from emergentintegrations.llm.chat import LlmChat, UserMessage
-    
+        return cached
+
+    from suggestion_engine import suggest_task
+    suggestion, confidence = suggest_task(data.title)
+    if confidence >= AI_RULES_CONFIDENCE:
+        if AI_RULES_REFINE and confidence < AI_RULES_FINAL_CONFIDENCE and rules_refined.get(title_hash) is None:
+            rules_refined.set(title_hash, True)
+            spawn(suggest_flight.do(title_hash, lambda: suggest_uncached(
+                data.title, title_hash, canonical, user["user_id"], PRIORITY_BACKGROUND
+            )))
+        return {**suggestion, "source": "rules", "confidence": confidence}
+
+    # Concurrent requests for the same uncached title share one LLM call
+    return await suggest_flight.do(title_hash, lambda: suggest_uncached(data.title, title_hash, canonical, user["user_id"]))
+
+async def llm_suggest(title: str, title_hash: str, canonical: str, user_id: str,
+                      priority: int = PRIORITY_SUGGEST) -> dict:
+    """Ask the LLM for suggestions and cache successful results in both tiers"""
     # Get current date info for context
     now = datetime.now(timezone.utc)
     today_str = now.strftime("%A, %B %d, %Y")
     
-    chat = LlmChat(
-        api_key=EMERGENT_LLM_KEY,
-        session_id=f"suggest_{uuid.uuid4().hex[:8]}",
-        system_message=f"""You are a task planning AI. Today is {today_str}. Given a task title, suggest:
+    system_message = f"""You are a task planning AI. Today is {today_str}. Given a task title, suggest:
 1. An emoji icon that represents the task
 2. Priority: "high", "medium", or "low"
 3. Estimated time in minutes
@@ -614,68 +1525,285 @@ Analyze the task for urgency signals:
 
 Respond in EXACTLY this JSON format, nothing else:
 {{"emoji": "📚", "priority": "medium", "estimated_time": 30, "category": "school", "tags": ["homework", "reading"], "suggested_due": "tomorrow", "suggested_reminder": "9:00"}}"""
-    )
-    chat.with_model("anthropic", "claude-sonnet-4-5-20250929")
-    msg = UserMessage(text=f"Task: {data.title}")
     try:
-        response = await asyncio.wait_for(chat.send_message(msg), timeout=8.0)
-        import json
+        response = await asyncio.wait_for(
+            llm.complete("anthropic", "claude-sonnet-4-5-20250929", system_message, f"Task: {title}", priority, user_id),
+            timeout=8.0
+        )
         cleaned = response.strip()
         if "```" in cleaned:
             cleaned = cleaned.split("```")[1].replace("json", "").strip()
         result = json.loads(cleaned)
         # Cache the result
-        await db.ai_cache.update_one(
-            {"title_hash": title_hash},
-            {"$set": {"title_hash": title_hash, "result": result, "created_at": datetime.now(timezone.utc)}},
-            upsert=True
-        )
+        await ai_cache_put("suggest", title_hash, result, canonical)
         return result
     except asyncio.TimeoutError:
-        logger.warning(f"AI SUGGEST: Timeout for '{data.title}'")
-        return {"emoji": "📝", "priority": "medium", "estimated_time": 30, "category": "general", "tags": [], "suggested_due": None, "suggested_reminder": None, "timeout": True}
+        logger.warning(f"AI SUGGEST: Timeout for '{title}'")
+        return {**copy.deepcopy(AI_SUGGEST_FALLBACK), "timeout": True}
+    except LLMOverloaded:
+        # Shed before reaching the provider: the keyword rules are the best answer we have
+        from suggestion_engine import suggest_task
+        logger.warning(f"AI SUGGEST: Shed under load for '{title}'")
+        return {**suggest_task(title)[0], "source": "rules"}
     except Exception as e:
         logger.error(f"AI suggest error: {e}")
-        return {"emoji": "📝", "priority": "medium", "estimated_time": 30, "category": "general", "tags": [], "suggested_due": None, "suggested_reminder": None}
+        return copy.deepcopy(AI_SUGGEST_FALLBACK)
+
+AI_BREAKDOWN_FALLBACK = {"subtasks": [{"title": "Get started", "estimated_time": 15}, {"title": "Work on it", "estimated_time": 30}, {"title": "Review & finish", "estimated_time": 15}]}
+breakdown_flight = SingleFlight()
 
 @api_router.post("/ai/breakdown")
-async def ai_breakdown_task(data: AISuggestRequest, user: dict = Depends(get_current_user)):
-    """AI breaks down a task into subtasks"""
-    from emergentintegrations.llm.chat import LlmChat, UserMessage
-    chat = LlmChat(
-        api_key=EMERGENT_LLM_KEY,
-        session_id=f"breakdown_{uuid.uuid4().hex[:8]}",
-        system_message="""You are a task breakdown expert. Given a task, create 3-6 clear subtasks with time estimates.
+async def ai_breakdown_task(data: AISuggestRequest, refresh: bool = False, user: dict = Depends(get_current_user)):
+    """AI breaks down a task into subtasks, cached on the same canonical title key as suggestions"""
+    canonical = canonical_title(data.title)
+    title_hash = canonical_key(canonical)
+    if not refresh:
+        cached = await ai_cache_get("breakdown", title_hash, canonical)
+        if cached is not None:
+            logger.info(f"AI BREAKDOWN: Cache hit for '{data.title}'")
+            return cached
+    return await breakdown_flight.do(title_hash, lambda: llm_breakdown(data.title, title_hash, canonical, user["user_id"]))
+
+async def llm_breakdown(title: str, title_hash: str, canonical: str, user_id: str) -> dict:
+    """Ask the LLM for subtasks and cache successful results in both tiers"""
+    system_message = """You are a task breakdown expert. Given a task, create 3-6 clear subtasks with time estimates.
 Respond in EXACTLY this JSON format, nothing else:
 {"subtasks": [{"title": "Research topic", "estimated_time": 30}, {"title": "Create outline", "estimated_time": 15}]}"""
-    )
-    chat.with_model("anthropic", "claude-sonnet-4-5-20250929")
-    msg = UserMessage(text=f"Break down this task into subtasks: {data.title}")
     try:
-        response = await asyncio.wait_for(chat.send_message(msg), timeout=8.0)
-        import json
+        response = await asyncio.wait_for(
+            llm.complete(
+                "anthropic", "claude-sonnet-4-5-20250929", system_message,
+                f"Break down this task into subtasks: {title}", PRIORITY_BREAKDOWN, user_id
+            ),
+            timeout=8.0
+        )
         cleaned = response.strip()
         if "```" in cleaned:
             cleaned = cleaned.split("```")[1].replace("json", "").strip()
         result = json.loads(cleaned)
+        await ai_cache_put("breakdown", title_hash, result, canonical)
         return result
     except Exception as e:
         logger.error(f"AI breakdown error: {e}")
-        return {"subtasks": [{"title": "Get started", "estimated_time": 15}, {"title": "Work on it", "estimated_time": 30}, {"title": "Review & finish", "estimated_time": 15}]}
-
-@api_router.post("/ai/chat")
-async def ai_chat(data: ChatMessage, user: dict = Depends(get_current_user)):
-    """AI chat with model switcher - OPTIMIZED: no history replay"""
-    from emergentintegrations.llm.chat import LlmChat, UserMessage
+        return copy.deepcopy(AI_BREAKDOWN_FALLBACK)
+
+# Max wait for the first token, and between tokens, on streamed replies
+LLM_STREAM_IDLE_TIMEOUT = 12.0
+# Keep proxies (nginx) from buffering the event stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse(event: str, data: dict) -> str:
+    """One Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def sse_reply(meta: dict, tokens: AsyncIterator[str], timeout_text: str, error_text: str, save) -> AsyncIterator[str]:
+    """Relay `tokens` as SSE frames, then persist the full reply with `save(content)`.
+
+    Emits `meta` first, a `token` frame per delta and a final `done` frame with
+    the whole response. A stall of LLM_STREAM_IDLE_TIMEOUT before the first
+    token (or an error) sends the usual fallback text instead; a stall after
+    some text ends the reply with what has arrived. If the client disconnects
+    mid-stream the partial reply is still saved.
+    """
+    parts = []
+    yield sse("meta", meta)
+    try:
+        iterator = tokens.__aiter__()
+        while True:
+            try:
+                delta = await asyncio.wait_for(iterator.__anext__(), timeout=LLM_STREAM_IDLE_TIMEOUT)
+            except StopAsyncIteration:
+                break
+            parts.append(delta)
+            yield sse("token", {"delta": delta})
+    except asyncio.TimeoutError:
+        logger.warning(f"AI STREAM: Stalled after {len(parts)} chunks")
+        if not parts:
+            parts.append(timeout_text)
+            yield sse("token", {"delta": timeout_text})
+    except Exception as e:
+        logger.error(f"AI STREAM error: {e}")
+        if not parts:
+            parts.append(error_text)
+            yield sse("token", {"delta": error_text})
+    finally:
+        if parts:
+            spawn(save("".join(parts)))
+    yield sse("done", {"response": "".join(parts)})
+
+# ─── Conversation Summaries ───
+
+# One small chat_summaries doc per session replaces re-reading message history on every turn:
+# the last few lines verbatim, lines that scrolled out ("pending") and a rolling LLM summary
+# that pending lines are folded into in the background.
+CHAT_RECENT_LINES = 6  # last 3 exchanges verbatim
+CHAT_SUMMARY_BATCH = 6  # fold pending lines into the summary this many at a time
+CHAT_PENDING_MAX = 40  # bound on unsummarized lines if summarizing keeps failing
+CHAT_SUMMARY_MAX_CHARS = 1500
+CHAT_SUMMARY_MODEL = ("gemini", "gemini-2.5-flash")
+summary_flight = SingleFlight()
+
+# Retention for chat_messages / persona_chats: TTL on expires_at plus a per-session message cap
+CHAT_RETENTION_DAYS = int(os.environ.get('CHAT_RETENTION_DAYS', '180'))
+CHAT_SESSION_MAX_MESSAGES = int(os.environ.get('CHAT_SESSION_MAX_MESSAGES', '200'))
+CHAT_TRIM_EVERY = 10  # exchanges between cap checks
+CHAT_HISTORY_PAGE_MAX = 100
+CHAT_HISTORY_PROJECTION = {"_id": 0, "expires_at": 0}
+# Chat message inserts are buffered off the request path; history reads flush first.
+# Other workers may see a message up to CHAT_WRITE_FLUSH_INTERVAL late.
+CHAT_WRITE_FLUSH_INTERVAL = float(os.environ.get('CHAT_WRITE_FLUSH_INTERVAL', '0.05'))
+chat_writes = WriteBehindBuffer(flush_interval=CHAT_WRITE_FLUSH_INTERVAL)
+
+def chat_expiry() -> datetime:
+    return datetime.now(timezone.utc) + timedelta(days=CHAT_RETENTION_DAYS)
+
+async def trim_session(collection, kind: str, user_id: str, session_id: str):
+    """Delete a session's oldest messages beyond CHAT_SESSION_MAX_MESSAGES.
+
+    The session's summary doc goes with them; the next turn reseeds it from
+    the messages that remain, so it never outlives what it summarizes.
+    """
+    await chat_writes.flush()
+    query = {"user_id": user_id, "session_id": session_id}
+    boundary = await collection.find(query, {"_id": 0, "created_at": 1}).sort(
+        "created_at", -1
+    ).skip(CHAT_SESSION_MAX_MESSAGES).limit(1).to_list(1)
+    if boundary:
+        result = await collection.delete_many({**query, "created_at": {"$lte": boundary[0]["created_at"]}})
+        logger.info(f"CHAT: Trimmed {result.deleted_count} old messages from session {session_id}")
+        if result.deleted_count:
+            await db.chat_summaries.delete_one(summary_filter(kind, user_id, session_id))
+
+async def chat_history_page(collection, query: dict, limit: int, before: Optional[str]) -> dict:
+    """Newest-first keyset page on (created_at, message_id), returned oldest-first for display"""
+    await chat_writes.flush()
+    if before:
+        created_at, message_id = decode_cursor(before)
+        query = {"$and": [query, {"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "message_id": {"$lt": message_id}}
+        ]}]}
+    messages = await collection.find(query, CHAT_HISTORY_PROJECTION).sort(
+        [("created_at", -1), ("message_id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = encode_cursor([messages[-1]["created_at"], messages[-1]["message_id"]])
+    messages.reverse()
+    return {"messages": messages, "next_cursor": next_cursor}
+
+def summary_filter(kind: str, user_id: str, session_id: str) -> dict:
+    return {"kind": kind, "user_id": user_id, "session_id": session_id}
+
+def conversation_text(doc: dict) -> str:
+    text = ""
+    if doc.get("summary"):
+        text += f"\n\nConversation so far (summary):\n{doc['summary']}"
+    lines = doc.get("pending", []) + doc.get("lines", [])
+    if lines:
+        text += "\n\nRecent conversation:\n" + "\n".join(lines)
+    return text
+
+async def load_conversation(kind: str, user_id: str, session_id: str, legacy, ai_label: str) -> str:
+    """Prompt context for a session: one indexed read of its summary doc"""
+    doc = await db.chat_summaries.find_one(
+        summary_filter(kind, user_id, session_id), {"_id": 0, "summary": 1, "pending": 1, "lines": 1}
+    )
+    if doc is not None:
+        return conversation_text(doc)
+    # Sessions started before summaries existed: seed the doc from their message history
+    # so record_exchange appends to it instead of starting the context over.
+    await chat_writes.flush()
+    history = await legacy.find(
+        {"user_id": user_id, "session_id": session_id},
+        {"_id": 0, "role": 1, "content": 1}
+    ).sort("created_at", -1).to_list(CHAT_PENDING_MAX + CHAT_RECENT_LINES)
+    if not history:
+        return ""
+    history.reverse()
+    lines = [f"{'User' if h['role'] == 'user' else ai_label}: {h['content'][:200]}" for h in history]
+    seed = {
+        "pending": lines[:-CHAT_RECENT_LINES],
+        "lines": lines[-CHAT_RECENT_LINES:],
+        "turns": len(lines) // 2,
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+        "expires_at": chat_expiry()
+    }
+    try:
+        await db.chat_summaries.update_one(summary_filter(kind, user_id, session_id), {"$setOnInsert": seed}, upsert=True)
+    except DuplicateKeyError:
+        pass  # a concurrent turn created it first
+    return conversation_text(seed)
+
+async def record_exchange(kind: str, user_id: str, session_id: str, ai_label: str, message: str, reply: str) -> int:
+    """Append one exchange; lines pushed out of the recent window queue up for summarizing. Returns the turn count."""
+    new_lines = [f"User: {message[:200]}", f"{ai_label}: {reply[:200]}"]
+    lines = {"$concatArrays": [{"$ifNull": ["$lines", []]}, new_lines]}
+    overflow = {"$subtract": [{"$size": "$lines"}, CHAT_RECENT_LINES]}
+    doc = await db.chat_summaries.find_one_and_update(
+        summary_filter(kind, user_id, session_id),
+        [
+            {"$set": {"lines": lines}},
+            {"$set": {
+                "pending": {"$slice": [
+                    {"$concatArrays": [
+                        {"$ifNull": ["$pending", []]},
+                        {"$cond": [{"$gt": [overflow, 0]}, {"$slice": ["$lines", 0, overflow]}, []]}
+                    ]},
+                    -CHAT_PENDING_MAX
+                ]},
+                "lines": {"$slice": ["$lines", -CHAT_RECENT_LINES]},
+                "turns": {"$add": [{"$ifNull": ["$turns", 0]}, 1]},
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+                # Expires with the session's newest message
+                "expires_at": chat_expiry()
+            }}
+        ],
+        projection={"_id": 0, "pending": 1, "turns": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    if len(doc.get("pending", [])) >= CHAT_SUMMARY_BATCH:
+        key = (kind, user_id, session_id)
+        spawn(summary_flight.do(key, lambda: fold_summary(kind, user_id, session_id)))
+    return doc.get("turns", 0)
+
+async def fold_summary(kind: str, user_id: str, session_id: str):
+    """Fold pending lines into the rolling summary with a cheap background LLM call"""
+    query = summary_filter(kind, user_id, session_id)
+    doc = await db.chat_summaries.find_one(query, {"_id": 0, "summary": 1, "pending": 1})
+    pending = (doc or {}).get("pending", [])
+    if len(pending) < CHAT_SUMMARY_BATCH:
+        return
+    system_message = (
+        "You maintain a running summary of a conversation between a user and an assistant. "
+        "Merge the new lines into the existing summary. Keep facts, goals, decisions and open questions; "
+        f"drop small talk. Reply with the updated summary only, under {CHAT_SUMMARY_MAX_CHARS // 6} words."
+    )
+    text = f"Existing summary:\n{doc.get('summary') or '(none)'}\n\nNew lines:\n" + "\n".join(pending)
+    try:
+        summary = await asyncio.wait_for(
+            llm.complete(*CHAT_SUMMARY_MODEL, system_message, text, PRIORITY_BACKGROUND, user_id),
+            timeout=30.0
+        )
+    except Exception as e:
+        logger.warning(f"CHAT SUMMARY: Failed for session {session_id}: {e}")
+        return
+    # Drop exactly the lines that were folded in; later arrivals stay pending
+    folded = len(pending)
+    await db.chat_summaries.update_one(query, [{"$set": {
+        "summary": summary.strip()[:CHAT_SUMMARY_MAX_CHARS],
+        "pending": {"$slice": ["$pending", folded, {"$max": [1, {"$size": "$pending"}]}]}
+    }}])
+
+async def prepare_chat(data: ChatMessage, user: dict):
+    """Resolve the model (unknown names fall back to claude), build the system prompt and store the user's message"""
     session_id = data.session_id or f"chat_{user['user_id']}_{uuid.uuid4().hex[:8]}"
 
-    model_map = {
-        "claude": ("anthropic", "claude-sonnet-4-5-20250929"),
-        "gpt4o": ("openai", "gpt-4o"),
-        "gemini": ("gemini", "gemini-2.5-flash"),
-    }
-    provider, model = model_map.get(data.ai_model, ("anthropic", "claude-sonnet-4-5-20250929"))
-    logger.info(f"AI CHAT: Using model={data.ai_model} → provider={provider}, model={model}")
+    ai_model = data.ai_model if data.ai_model in MODEL_MAP else "claude"
+    provider, model = MODEL_MAP[ai_model]
+    logger.info(f"AI CHAT: Using model={ai_model} → provider={provider}, model={model}")
 
     # Get user's tasks for context (limit to 5 for speed)
     tasks = await db.tasks.find({"user_id": user["user_id"], "completed": False}, {"_id": 0}).to_list(5)
@@ -684,19 +1812,8 @@ async def ai_chat(data: ChatMessage, user: dict = Depends(get_current_user)):
         task_list = "\n".join([f"- {t['title']} ({t['priority']})" for t in tasks[:5]])
         task_context = f"\n\nUser's pending tasks:\n{task_list}"
 
-    # Build conversation history as context in system message (NO API replay)
-    history = await db.chat_messages.find(
-        {"user_id": user["user_id"], "session_id": session_id},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(10)
-    history.reverse()
-
-    history_text = ""
-    if history:
-        recent = history[-6:]  # Last 3 exchanges max
-        history_text = "\n\nRecent conversation:\n" + "\n".join(
-            [f"{'User' if h['role'] == 'user' else 'AI'}: {h['content'][:200]}" for h in recent]
-        )
+    # Conversation context in system message (NO API replay)
+    history_text = await load_conversation("chat", user["user_id"], session_id, db.chat_messages, "AI")
 
     system_msg = f"""You are Taskly AI, a friendly task management assistant. Be concise, helpful, encouraging. Use emojis occasionally.
 
@@ -709,59 +1826,108 @@ User: {user.get('name', 'Friend')} | Level {user.get('level', 1)} | {user.get('x
         "session_id": session_id,
         "role": "user",
         "content": data.message,
-        "ai_model": data.ai_model,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "ai_model": ai_model,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "expires_at": chat_expiry()
     }
-    await db.chat_messages.insert_one(user_msg_doc)
+    chat_writes.add(db.chat_messages, user_msg_doc)
+    return session_id, ai_model, provider, model, system_msg
 
-    # Single API call - no history replay
-    chat = LlmChat(
-        api_key=EMERGENT_LLM_KEY,
-        session_id=f"taskly_{session_id}_{data.ai_model}",
-        system_message=system_msg
-    )
-    chat.with_model(provider, model)
+async def save_chat_reply(user_id: str, session_id: str, ai_model: str, message: str, content: str):
+    turns = await record_exchange("chat", user_id, session_id, "AI", message, content)
+    chat_writes.add(db.chat_messages, {
+        "message_id": f"msg_{uuid.uuid4().hex[:12]}",
+        "user_id": user_id,
+        "session_id": session_id,
+        "role": "assistant",
+        "content": content,
+        "ai_model": ai_model,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "expires_at": chat_expiry()
+    })
+    if turns % CHAT_TRIM_EVERY == 0:
+        spawn(trim_session(db.chat_messages, "chat", user_id, session_id))
+
+def hedge_partner(provider: str):
+    """(ai_model, (provider, model)) of the first MODEL_MAP entry served by a different provider"""
+    return next((key, pm) for key, pm in MODEL_MAP.items() if pm[0] != provider)
+
+def chat_fallbacks(ai_model: str):
+    timeout_text = f"I'm taking too long to respond. Please try again! The {AI_MODELS_DISPLAY.get(ai_model, 'AI')} might be busy. 🤖"
+    return timeout_text, "I'm having trouble connecting right now. Please try again! 🤖"
+
+@api_router.post("/ai/chat")
+async def ai_chat(data: ChatMessage, user: dict = Depends(get_current_user)):
+    """AI chat with model switcher - OPTIMIZED: no history replay"""
+    session_id, ai_model, provider, model, system_msg = await prepare_chat(data, user)
+    timeout_text, error_text = chat_fallbacks(ai_model)
+    requested_model = ai_model
 
-    msg = UserMessage(text=data.message)
+    # Single API call - no history replay
+    if AI_CHAT_HEDGING:
+        partner_model, partner = hedge_partner(provider)
+        call = llm.complete_hedged(
+            (provider, model), partner, system_msg, data.message, PRIORITY_CHAT, user["user_id"]
+        )
+    else:
+        call = llm.complete(provider, model, system_msg, data.message, PRIORITY_CHAT, user["user_id"])
     try:
-        response = await asyncio.wait_for(chat.send_message(msg), timeout=12.0)
-        logger.info(f"AI CHAT: Got response from {data.ai_model} ({len(response)} chars)")
+        response = await asyncio.wait_for(call, timeout=12.0)
+        if AI_CHAT_HEDGING:
+            response, answered_by = response
+            if answered_by != provider:
+                # Attribute the reply to the model that actually wrote it
+                ai_model = partner_model
+                logger.info(f"AI CHAT: Hedged {requested_model} request answered by {ai_model}")
+        logger.info(f"AI CHAT: Got response from {ai_model} ({len(response)} chars)")
     except asyncio.TimeoutError:
-        logger.warning(f"AI CHAT: Timeout for model {data.ai_model}")
-        response = f"I'm taking too long to respond. Please try again! The {AI_MODELS_DISPLAY.get(data.ai_model, 'AI')} might be busy. 🤖"
+        logger.warning(f"AI CHAT: Timeout for model {requested_model}")
+        response = timeout_text
     except Exception as e:
-        logger.error(f"AI CHAT error ({data.ai_model}): {e}")
-        response = "I'm having trouble connecting right now. Please try again! 🤖"
+        logger.error(f"AI CHAT error ({requested_model}): {e}")
+        response = error_text
 
     # Store AI response
-    ai_msg_doc = {
-        "message_id": f"msg_{uuid.uuid4().hex[:12]}",
-        "user_id": user["user_id"],
-        "session_id": session_id,
-        "role": "assistant",
-        "content": response,
-        "ai_model": data.ai_model,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.chat_messages.insert_one(ai_msg_doc)
-
-    return {"response": response, "session_id": session_id, "ai_model": data.ai_model}
+    await save_chat_reply(user["user_id"], session_id, ai_model, data.message, response)
+
+    return {"response": response, "session_id": session_id, "ai_model": ai_model}
+
+@api_router.post("/ai/chat/stream")
+async def ai_chat_stream(data: ChatMessage, user: dict = Depends(get_current_user)):
+    """Same as /ai/chat, streamed as text/event-stream (meta, token..., done)"""
+    session_id, ai_model, provider, model, system_msg = await prepare_chat(data, user)
+    timeout_text, error_text = chat_fallbacks(ai_model)
+    # Streams are not hedged, so the resolved model is the one that answers
+    frames = sse_reply(
+        {"session_id": session_id, "ai_model": ai_model},
+        llm.stream(provider, model, system_msg, data.message, PRIORITY_CHAT, user["user_id"]),
+        timeout_text, error_text,
+        lambda content: save_chat_reply(user["user_id"], session_id, ai_model, data.message, content)
+    )
+    return StreamingResponse(frames, media_type="text/event-stream", headers=SSE_HEADERS)
 
 @api_router.get("/ai/chat-history")
-async def get_chat_history(session_id: str = None, user: dict = Depends(get_current_user)):
+async def get_chat_history(
+    session_id: str = None,
+    limit: Optional[int] = Query(None, ge=1, le=CHAT_HISTORY_PAGE_MAX),
+    before: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Chat messages oldest-first. With `limit`/`before`, pages backwards from the newest
+    and returns {"messages", "next_cursor"}; otherwise the legacy plain list."""
     query = {"user_id": user["user_id"]}
     if session_id:
         query["session_id"] = session_id
-    messages = await db.chat_messages.find(query, {"_id": 0}).sort("created_at", 1).to_list(100)
-    return messages
+    if limit is None and before is None:
+        await chat_writes.flush()
+        return await db.chat_messages.find(query, CHAT_HISTORY_PROJECTION).sort("created_at", 1).to_list(100)
+    return await chat_history_page(db.chat_messages, query, limit or 50, before)
 
 # ─── Persona Chat Route ───
 
-@api_router.post("/ai/persona-chat")
-async def persona_chat(data: PersonaChatRequest, user: dict = Depends(get_current_user)):
-    """Contextual AI chat with a specialized persona for a specific task."""
+async def prepare_persona_chat(data: PersonaChatRequest, user: dict):
+    """Load the task and persona, build the system prompt and store the user's message"""
     from persona_system import get_persona, get_persona_system_prompt
-    from emergentintegrations.llm.chat import LlmChat, UserMessage
     
     # Get task context
     task = await db.tasks.find_one({"task_id": data.task_id, "user_id": user["user_id"]}, {"_id": 0})
@@ -771,19 +1937,8 @@ async def persona_chat(data: PersonaChatRequest, user: dict = Depends(get_curren
     persona = get_persona(data.persona_id)
     session_id = data.session_id or f"persona_{data.task_id}_{uuid.uuid4().hex[:8]}"
     
-    # Build conversation history
-    history = await db.persona_chats.find(
-        {"user_id": user["user_id"], "session_id": session_id},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(10)
-    history.reverse()
-    
-    history_text = ""
-    if history:
-        recent = history[-6:]
-        history_text = "\n\nRecent conversation:\n" + "\n".join(
-            [f"{'User' if h['role'] == 'user' else persona['name']}: {h['content'][:200]}" for h in recent]
-        )
+    # Conversation context
+    history_text = await load_conversation("persona", user["user_id"], session_id, db.persona_chats, persona["name"])
     
     system_msg = get_persona_system_prompt(data.persona_id, task["title"]) + history_text
     
@@ -796,21 +1951,39 @@ async def persona_chat(data: PersonaChatRequest, user: dict = Depends(get_curren
         "session_id": session_id,
         "role": "user",
         "content": data.message,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "expires_at": chat_expiry()
     }
-    await db.persona_chats.insert_one(user_msg_doc)
+    chat_writes.add(db.persona_chats, user_msg_doc)
+    return task, persona, session_id, system_msg
+
+async def save_persona_reply(user_id: str, data: PersonaChatRequest, session_id: str, persona: dict, content: str):
+    turns = await record_exchange("persona", user_id, session_id, persona["name"], data.message, content)
+    chat_writes.add(db.persona_chats, {
+        "message_id": f"msg_{uuid.uuid4().hex[:12]}",
+        "user_id": user_id,
+        "task_id": data.task_id,
+        "persona_id": data.persona_id,
+        "session_id": session_id,
+        "role": "assistant",
+        "content": content,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "expires_at": chat_expiry()
+    })
+    if turns % CHAT_TRIM_EVERY == 0:
+        spawn(trim_session(db.persona_chats, "persona", user_id, session_id))
+
+@api_router.post("/ai/persona-chat")
+async def persona_chat(data: PersonaChatRequest, user: dict = Depends(get_current_user)):
+    """Contextual AI chat with a specialized persona for a specific task."""
+    task, persona, session_id, system_msg = await prepare_persona_chat(data, user)
     
     # Call AI (using Claude for persona chats - best for roleplay)
-    chat = LlmChat(
-        api_key=EMERGENT_LLM_KEY,
-        session_id=f"persona_{session_id}",
-        system_message=system_msg
-    )
-    chat.with_model("anthropic", "claude-sonnet-4-5-20250929")
-    
-    msg = UserMessage(text=data.message)
     try:
-        response = await asyncio.wait_for(chat.send_message(msg), timeout=12.0)
+        response = await asyncio.wait_for(
+            llm.complete("anthropic", "claude-sonnet-4-5-20250929", system_msg, data.message, PRIORITY_CHAT, user["user_id"]),
+            timeout=12.0
+        )
         logger.info(f"PERSONA CHAT: {persona['name']} responded for task '{task['title'][:30]}...'")
     except asyncio.TimeoutError:
         response = f"I'm taking a moment to think... Please try again! {persona['emoji']}"
@@ -819,17 +1992,7 @@ async def persona_chat(data: PersonaChatRequest, user: dict = Depends(get_curren
         response = f"I'm having trouble connecting right now. Try again? {persona['emoji']}"
     
     # Store AI response
-    ai_msg_doc = {
-        "message_id": f"msg_{uuid.uuid4().hex[:12]}",
-        "user_id": user["user_id"],
-        "task_id": data.task_id,
-        "persona_id": data.persona_id,
-        "session_id": session_id,
-        "role": "assistant",
-        "content": response,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.persona_chats.insert_one(ai_msg_doc)
+    await save_persona_reply(user["user_id"], data, session_id, persona, response)
     
     return {
         "response": response,
@@ -839,6 +2002,37 @@ async def persona_chat(data: PersonaChatRequest, user: dict = Depends(get_curren
         "persona_emoji": persona["emoji"]
     }
 
+@api_router.post("/ai/persona-chat/stream")
+async def persona_chat_stream(data: PersonaChatRequest, user: dict = Depends(get_current_user)):
+    """Same as /ai/persona-chat, streamed as text/event-stream (meta, token..., done)"""
+    task, persona, session_id, system_msg = await prepare_persona_chat(data, user)
+    meta = {
+        "session_id": session_id,
+        "persona_id": data.persona_id,
+        "persona_name": persona["name"],
+        "persona_emoji": persona["emoji"]
+    }
+    frames = sse_reply(
+        meta,
+        llm.stream("anthropic", "claude-sonnet-4-5-20250929", system_msg, data.message, PRIORITY_CHAT, user["user_id"]),
+        f"I'm taking a moment to think... Please try again! {persona['emoji']}",
+        f"I'm having trouble connecting right now. Try again? {persona['emoji']}",
+        lambda content: save_persona_reply(user["user_id"], data, session_id, persona, content)
+    )
+    return StreamingResponse(frames, media_type="text/event-stream", headers=SSE_HEADERS)
+
+@api_router.get("/ai/persona-chat/history")
+async def get_persona_chat_history(
+    session_id: str,
+    limit: int = Query(50, ge=1, le=CHAT_HISTORY_PAGE_MAX),
+    before: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Persona chat messages for one session, paged backwards from the newest"""
+    return await chat_history_page(
+        db.persona_chats, {"user_id": user["user_id"], "session_id": session_id}, limit, before
+    )
+
 @api_router.get("/ai/personas")
 async def get_personas():
     """Get all available AI personas."""
@@ -848,7 +2042,7 @@ async def get_personas():
 # ─── Dashboard Route ───
 
 @api_router.get("/dashboard")
-async def get_dashboard(user: dict = Depends(get_current_user)):
+async def get_dashboard(request: Request, response: Response, fields: str = "summary", user: dict = Depends(get_current_user)):
     now = datetime.now(timezone.utc)
     hour = now.hour
     if hour < 12:
@@ -857,19 +2051,15 @@ async def get_dashboard(user: dict = Depends(get_current_user)):
         greeting = "Good Afternoon"
     else:
         greeting = "Good Evening"
+    not_modified = await etag_response(request, response, user, now.strftime("%Y-%m-%d"), greeting)
+    if not_modified:
+        return not_modified
 
-    today_start = now.replace(hour=0, minute=0, second=0).isoformat()
-    today_end = now.replace(hour=23, minute=59, second=59).isoformat()
-
+    stats = await get_task_stats(user)
     today_tasks = await db.tasks.find(
         {"user_id": user["user_id"], "completed": False},
-        {"_id": 0}
-    ).sort("priority", 1).to_list(50)
-
-    completed_today = await db.tasks.count_documents({
-        "user_id": user["user_id"], "completed": True,
-        "completed_at": {"$gte": today_start, "$lte": today_end}
-    })
+        task_projection(fields)
+    ).sort("priority", 1).to_list(5)
 
     quotes = [
         "The secret of getting ahead is getting started. — Mark Twain",
@@ -890,9 +2080,9 @@ async def get_dashboard(user: dict = Depends(get_current_user)):
         "xp": user.get("xp", 0),
         "level": user.get("level", 1),
         "streak": user.get("streak", 0),
-        "today_tasks": today_tasks[:5],
-        "completed_today": completed_today,
-        "total_pending": len(today_tasks),
+        "today_tasks": today_tasks,
+        "completed_today": stats["completed_today"],
+        "total_pending": stats["active"],
         "quote": random.choice(quotes),
         "unread_notifications": unread,
         "mascot": user.get("mascot", "owl")
@@ -916,22 +2106,15 @@ async def get_quote():
 @api_router.post("/dev/simulate-day")
 async def dev_simulate_day(user: dict = Depends(get_current_user)):
     """Simulate advancing one day for streak testing"""
-    current_streak = user.get("streak", 0)
     today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    await db.users.update_one(
-        {"user_id": user["user_id"]},
-        {"$set": {"streak": current_streak + 1, "streak_last_date": today}}
-    )
-    await check_badges(user["user_id"])
-    return {"message": f"Streak advanced to {current_streak + 1}", "streak": current_streak + 1}
+    updated = await update_user(user["user_id"], {"$inc": {"streak": 1}, "$set": {"streak_last_date": today}})
+    await check_badges(updated)
+    return {"message": f"Streak advanced to {updated['streak']}", "streak": updated["streak"]}
 
 @api_router.post("/dev/reset-streak")
 async def dev_reset_streak(user: dict = Depends(get_current_user)):
     """Reset streak to 0"""
-    await db.users.update_one(
-        {"user_id": user["user_id"]},
-        {"$set": {"streak": 0, "streak_last_date": ""}}
-    )
+    await update_user(user["user_id"], {"$set": {"streak": 0, "streak_last_date": ""}})
     return {"message": "Streak reset to 0", "streak": 0}
 
 @api_router.post("/dev/add-xp")
@@ -939,14 +2122,13 @@ async def dev_add_xp(request: Request, user: dict = Depends(get_current_user)):
     """Add XP for testing"""
     body = await request.json()
     xp_to_add = body.get("xp", 50)
-    new_xp = user.get("xp", 0) + xp_to_add
-    new_level = max(1, new_xp // 100 + 1)
-    await db.users.update_one(
-        {"user_id": user["user_id"]},
-        {"$set": {"xp": new_xp, "level": new_level}}
-    )
-    await check_badges(user["user_id"])
-    return {"message": f"Added {xp_to_add} XP", "xp": new_xp, "level": new_level}
+    # Add to the stored XP, not the (possibly stale) cached user
+    updated = await update_user(user["user_id"], [
+        {"$set": {"xp": {"$add": [{"$ifNull": ["$xp", 0]}, xp_to_add]}}},
+        {"$set": {"level": level_expr("$xp")}}
+    ])
+    await check_badges(updated)
+    return {"message": f"Added {xp_to_add} XP", "xp": updated["xp"], "level": updated["level"]}
 
 @api_router.post("/dev/trigger-badge")
 async def dev_trigger_badge(request: Request, user: dict = Depends(get_current_user)):
@@ -956,13 +2138,45 @@ async def dev_trigger_badge(request: Request, user: dict = Depends(get_current_u
     badge_def = next((b for b in BADGE_DEFINITIONS if b["badge_type"] == badge_type), None)
     if not badge_def:
         raise HTTPException(status_code=400, detail="Invalid badge type")
-    existing_badges = set(b.get("badge_type") for b in user.get("badges", []))
-    if badge_type not in existing_badges:
-        badge = {**badge_def, "earned_at": datetime.now(timezone.utc).isoformat()}
-        await db.users.update_one({"user_id": user["user_id"]}, {"$push": {"badges": badge}})
-        await create_notification(user["user_id"], "badge", f"Badge Unlocked: {badge_def['name']}!", f"{badge_def['icon']} {badge_def['description']}", user.get("mascot", "owl"))
+    badge = {**badge_def, "earned_at": datetime.now(timezone.utc).isoformat()}
+    await push_badges(user["user_id"], [badge], user.get("mascot", "owl"))
     return {"message": f"Badge '{badge_def['name']}' triggered", "badge": badge_def}
 
+@api_router.post("/dev/reconcile-stats")
+async def dev_reconcile_stats(user: dict = Depends(get_current_user)):
+    """Rebuild materialized task counters from the tasks collection"""
+    stats = await rebuild_task_stats(user["user_id"])
+    return {"message": "Task stats rebuilt", "task_stats": stats}
+
+@api_router.post("/dev/reclassify-personas")
+async def dev_reclassify_personas(resume: bool = False, user: dict = Depends(get_current_user)):
+    """Start a background persona reclassification of this user's tasks; poll /dev/jobs/{job_id}.
+    Reclassifying every user's tasks is CLI-only: `python maintenance.py reclassify-personas`."""
+    from maintenance import start_reclassify_personas
+    job, run = await start_reclassify_personas(user["user_id"], resume=resume)
+    spawn(run)
+    return job
+
+@api_router.get("/dev/jobs/{job_id}")
+async def dev_get_job(job_id: str, user: dict = Depends(get_current_user)):
+    """Progress of one of this user's maintenance jobs"""
+    job = await db.jobs.find_one({"job_id": job_id, "scope": user["user_id"]}, {"_id": 0, "last_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@api_router.get("/dev/cache-stats")
+async def dev_cache_stats(user: dict = Depends(get_current_user)):
+    """In-process cache hit/miss counters for this worker"""
+    return {
+        "user_cache": user_cache.stats(),
+        "ai_cache": ai_cache_stats(),
+        "suggest_flight": suggest_flight.stats(),
+        "breakdown_flight": breakdown_flight.stats(),
+        "llm": llm.stats(),
+        "chat_writes": chat_writes.stats(),
+    }
+
 # ─── Root ───
 @api_router.get("/")
 async def root():
@@ -979,10 +2193,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def start_llm_gateway():
+    await llm.start()
+    transports = await llm.verify(dict(MODEL_MAP.values()))
+    logger.info(f"LLM transports: {transports}")
+    buffered = [p for p in transports if not llm.streams(p)]
+    if buffered and LLM_REQUIRE_STREAMING:
+        raise RuntimeError(f"LLM replies would not stream for {', '.join(buffered)} (LLM_REQUIRE_STREAMING is set)")
+
+@app.on_event("startup")
+async def start_chat_writes():
+    await chat_writes.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Spawned saves still add chat messages to the buffer; let them finish before closing it
+    while background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    await chat_writes.close()  # last buffered chat messages must land before the client goes away
     client.close()
 
+@app.on_event("shutdown")
+async def close_llm_gateway():
+    await llm.close()
+
+async def ensure_ttl_index(collection, field: str, seconds: int):
+    """Create a TTL index, or retune an existing one in place when the TTL changed"""
+    try:
+        await collection.create_index(field, expireAfterSeconds=seconds)
+    except OperationFailure as e:
+        if e.code != 85:  # IndexOptionsConflict
+            raise
+        await db.command("collMod", collection.name, index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds})
+
 @app.on_event("startup")
 async def create_indexes():
     """Create MongoDB indexes for performance"""
@@ -990,12 +2234,31 @@ async def create_indexes():
         await db.users.create_index("user_id", unique=True)
         await db.users.create_index("email")
         await db.tasks.create_index([("user_id", 1), ("completed", 1)])
-        await db.tasks.create_index([("user_id", 1), ("created_at", -1)])
+        await db.tasks.create_index([("user_id", 1), ("created_at", -1), ("task_id", -1)])
         await db.tasks.create_index([("user_id", 1), ("completed_at", -1)])
-        await db.chat_messages.create_index([("user_id", 1), ("session_id", 1)])
+        await db.tasks.create_index([("user_id", 1), ("updated_at", 1), ("task_id", 1)])
+        await db.task_tombstones.create_index([("user_id", 1), ("deleted_at", 1)])
+        await db.task_tombstones.create_index("expires_at", expireAfterSeconds=0)
+        for collection in (db.chat_messages, db.persona_chats):
+            await collection.create_index([("user_id", 1), ("session_id", 1), ("created_at", -1), ("message_id", -1)])
+            await collection.create_index([("user_id", 1), ("created_at", -1), ("message_id", -1)])
+            await collection.create_index("expires_at", expireAfterSeconds=0)
+        try:
+            # Superseded by the (user_id, session_id, created_at, message_id) index
+            await db.chat_messages.drop_index("user_id_1_session_id_1")
+        except OperationFailure:
+            pass
+        await db.chat_summaries.create_index([("user_id", 1), ("session_id", 1), ("kind", 1)], unique=True)
+        await db.chat_summaries.create_index("expires_at", expireAfterSeconds=0)
         await db.notifications.create_index([("user_id", 1), ("created_at", -1)])
-        await db.ai_cache.create_index("title_hash", unique=True)
-        await db.ai_cache.create_index("created_at", expireAfterSeconds=3600)
+        await db.daily_activity.create_index([("user_id", 1), ("date", 1)], unique=True)
+        await db.jobs.create_index("job_id", unique=True)
+        await db.jobs.create_index([("name", 1), ("scope", 1), ("started_at", -1)])
+        for collection in AI_CACHE_COLLECTIONS.values():
+            await collection.create_index("title_hash", unique=True)
+            await collection.create_index("trigrams")
+            await ensure_ttl_index(collection, "created_at", AI_CACHE_TTL)
+        await db.ai_leases.create_index("expires_at", expireAfterSeconds=0)
         logger.info("MongoDB indexes created successfully")
     except Exception as e:
         logger.warning(f"Index creation warning: {e}")
@@ -0,0 +1,81 @@
+"""Rule-based task suggestions for TASKLY - instant fast path in front of the LLM"""
+
+from typing import Dict, Optional, Tuple
+import re
+
+from persona_system import PERSONAS, score_personas
+
+# Per-persona defaults, in the same vocabulary the LLM prompt uses
+PERSONA_DEFAULTS = {
+    "financial": {"category": "personal", "estimated_time": 20, "reminder": "18:00"},
+    "fitness": {"category": "health", "estimated_time": 45, "reminder": "9:00"},
+    "study": {"category": "school", "estimated_time": 45, "reminder": "14:00"},
+    "career": {"category": "work", "estimated_time": 30, "reminder": "9:00"},
+    "life": {"category": "chores", "estimated_time": 20, "reminder": "18:00"},
+    "creative": {"category": "creative", "estimated_time": 60, "reminder": "18:00"},
+    "wellness": {"category": "health", "estimated_time": 15, "reminder": "9:00"},
+    "cooking": {"category": "chores", "estimated_time": 45, "reminder": "18:00"},
+}
+
+# (pattern, suggested_due, priority) - first match wins
+URGENCY_RULES = [
+    (r"urgent|asap|immediately|right now|today|tonight|overdue", "today", "high"),
+    (r"tomorrow|deadline|due|before", "tomorrow", "high"),
+    (r"weekend|saturday|sunday", "this_weekend", None),
+    (r"next week", "next_week", None),
+    (r"someday|eventually|maybe|whenever", None, "low"),
+]
+
+TIME_OF_DAY_RULES = [
+    (r"morning|breakfast|sunrise", "9:00"),
+    (r"afternoon|lunch|noon", "14:00"),
+    (r"evening|tonight|dinner|night", "18:00"),
+]
+
+# Keyword weight (summed length of distinct matches) that counts as a confident match
+STRONG_SCORE = 6
+
+
+_URGENCY = [(re.compile(rf"\b(?:{pattern})\b"), due, priority) for pattern, due, priority in URGENCY_RULES]
+_TIME_OF_DAY = [(re.compile(rf"\b(?:{pattern})\b"), reminder) for pattern, reminder in TIME_OF_DAY_RULES]
+
+
+def suggest_task(title: str) -> Tuple[Dict, float]:
+    """Build a suggestion in the /ai/suggest response shape from keyword rules.
+
+    Returns (suggestion, confidence). Confidence is 0 when no persona keyword
+    matched, and otherwise grows with keyword weight and shrinks when a second
+    persona matches nearly as well.
+    """
+    text = title.lower()
+    matches = score_personas(text)
+    if matches:
+        best_score, persona_id, keywords = matches[0]
+        runner_up = matches[1][0] if len(matches) > 1 else 0
+        confidence = min(1.0, best_score / STRONG_SCORE) * (1 - runner_up / best_score)
+    else:
+        persona_id, keywords, confidence = "life", [], 0.0
+    defaults = PERSONA_DEFAULTS[persona_id]
+
+    due, priority = None, "medium"
+    for pattern, rule_due, rule_priority in _URGENCY:
+        if pattern.search(text):
+            due, priority = rule_due, rule_priority or priority
+            break
+
+    reminder: Optional[str] = defaults["reminder"] if due else None
+    for pattern, rule_reminder in _TIME_OF_DAY:
+        if pattern.search(text):
+            reminder = rule_reminder
+            break
+
+    suggestion = {
+        "emoji": PERSONAS[persona_id]["emoji"],
+        "priority": priority,
+        "estimated_time": defaults["estimated_time"],
+        "category": defaults["category"],
+        "tags": keywords[:3],
+        "suggested_due": due,
+        "suggested_reminder": reminder,
+    }
+    return suggestion, round(confidence, 2)
@@ -0,0 +1,29 @@
+"""
+Persona classifier tests
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from persona_system import classify_task_persona, classify_task_personas, score_personas
+
+
+class TestClassifyTaskPersona:
+    def test_whole_words_only(self):
+        """Keywords only match whole words, optionally with a plural/verb suffix"""
+        assert classify_task_persona("Go running") == "fitness"
+        assert classify_task_persona("Study for exams") == "study"
+        assert score_personas("display settings") == []
+        assert classify_task_persona("display settings") == "life"
+
+    def test_symbol_and_hyphenated_keywords(self):
+        """Keywords that start or end with punctuation still match"""
+        assert classify_task_persona("Transfer $50") == "financial"
+        assert classify_task_persona("self-care sunday") == "wellness"
+
+    def test_description_and_batch(self):
+        """The batch API accepts titles or (title, description) pairs"""
+        assert classify_task_persona("Sunday plans", "meal prep and grocery run") == "cooking"
+        assert classify_task_personas(["Pay rent", ("Sunday plans", "meal prep"), "Call mom"]) == [
+            "financial", "cooking", "life",
+        ]
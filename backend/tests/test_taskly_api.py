@@ -2,9 +2,11 @@
 Comprehensive Backend API Tests for TASKLY
 Tests: Auth (guest/register/login), Tasks CRUD, AI features, Dashboard, Gamification, Notifications
 """
+import base64
 import pytest
 import requests
 import os
+import json
 import time
 
 BASE_URL = os.environ.get('EXPO_PUBLIC_BACKEND_URL', 'https://schedule-manager-59.preview.emergentagent.com').rstrip('/')
@@ -220,6 +222,77 @@ class TestTasksCRUD:
         tasks = response.json()
         assert isinstance(tasks, list)
     
+    def test_get_tasks_paginated(self, guest_user, api_client):
+        """limit/after should walk all tasks newest first without overlap"""
+        created = [
+            api_client.post(f"{BASE_URL}/api/tasks", json={"title": f"TEST_Page Task {i}"}).json()["task_id"]
+            for i in range(5)
+        ]
+        
+        seen = []
+        cursor = None
+        while True:
+            url = f"{BASE_URL}/api/tasks?limit=2" + (f"&after={cursor}" if cursor else "")
+            response = api_client.get(url)
+            assert response.status_code == 200
+            page = response.json()
+            assert len(page["tasks"]) <= 2
+            seen.extend(t["task_id"] for t in page["tasks"])
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        
+        assert len(seen) == len(set(seen))
+        assert seen[:5] == list(reversed(created))
+    
+    def test_get_tasks_field_projection(self, guest_user, api_client):
+        """List defaults to a compact summary; fields= widens or narrows it"""
+        api_client.post(f"{BASE_URL}/api/tasks", json={
+            "title": "TEST_Projection Task",
+            "description": "Long description",
+            "subtasks": [{"title": "Step"}]
+        })
+        
+        summary = api_client.get(f"{BASE_URL}/api/tasks?limit=1").json()["tasks"][0]
+        assert summary["title"] == "TEST_Projection Task"
+        assert "description" not in summary
+        assert summary["subtasks"] == [{"completed": False}]
+        
+        full = api_client.get(f"{BASE_URL}/api/tasks?limit=1&fields=full").json()["tasks"][0]
+        assert full["description"] == "Long description"
+        
+        narrow = api_client.get(f"{BASE_URL}/api/tasks?limit=1&fields=title").json()["tasks"][0]
+        assert set(narrow) == {"task_id", "created_at", "title"}
+        
+        bad = api_client.get(f"{BASE_URL}/api/tasks?fields=password_hash")
+        assert bad.status_code == 400
+    
+    def test_sync_returns_changes_and_tombstones(self, guest_user, api_client):
+        """Delta sync should report creates/updates since the cursor and deletions as ids"""
+        kept = api_client.post(f"{BASE_URL}/api/tasks", json={"title": "TEST_Sync Keep"}).json()
+        gone = api_client.post(f"{BASE_URL}/api/tasks", json={"title": "TEST_Sync Gone"}).json()
+        
+        full = api_client.get(f"{BASE_URL}/api/tasks/sync").json()
+        assert {kept["task_id"], gone["task_id"]} <= {t["task_id"] for t in full["tasks"]}
+        cursor = full["cursor"]
+        
+        api_client.put(f"{BASE_URL}/api/tasks/{kept['task_id']}", json={"title": "TEST_Sync Renamed"})
+        api_client.delete(f"{BASE_URL}/api/tasks/{gone['task_id']}")
+        
+        delta = api_client.get(f"{BASE_URL}/api/tasks/sync?since={cursor}").json()
+        assert delta["full_resync"] is False
+        renamed = [t for t in delta["tasks"] if t["task_id"] == kept["task_id"]]
+        assert renamed and renamed[0]["title"] == "TEST_Sync Renamed"
+        assert gone["task_id"] in delta["deleted"]
+    
+    def test_get_tasks_invalid_cursor(self, guest_user, api_client):
+        response = api_client.get(f"{BASE_URL}/api/tasks?limit=2&after=not-a-cursor")
+        assert response.status_code == 400
+        for values in [["a"], ["a", "b", "c"], [{"$gt": ""}, "b"], [1, "b"]]:
+            cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+            assert api_client.get(f"{BASE_URL}/api/tasks?limit=2&after={cursor}").status_code == 400
+            assert api_client.get(f"{BASE_URL}/api/tasks/sync?since={cursor}").status_code == 400
+    
     def test_update_task(self, guest_user, api_client):
         """Should update task fields"""
         # Create task
@@ -241,6 +314,15 @@ class TestTasksCRUD:
         assert updated_task["title"] == "TEST_Updated Title"
         assert updated_task["priority"] == "high"
     
+    def test_update_task_title_reclassifies_persona(self, guest_user, api_client):
+        """Changing the title should recompute the denormalized persona fields"""
+        task = api_client.post(f"{BASE_URL}/api/tasks", json={"title": "TEST_Pay rent"}).json()
+        assert task["persona_id"] == "financial"
+        
+        updated = api_client.put(f"{BASE_URL}/api/tasks/{task['task_id']}", json={"title": "TEST_Go running"}).json()
+        assert updated["persona_id"] == "fitness"
+        assert updated["persona_name"] == "Fitness Coach"
+    
     def test_complete_task_awards_xp(self, guest_user, api_client):
         """Completing a task should award XP and update streak"""
         # Get initial user data
@@ -266,6 +348,42 @@ class TestTasksCRUD:
         updated_me = api_client.get(f"{BASE_URL}/api/auth/me").json()
         assert updated_me["xp"] > initial_xp
     
+    def test_batch_operations(self, guest_user, api_client):
+        """POST /tasks/batch should apply mixed operations and report per-item results"""
+        initial_xp = api_client.get(f"{BASE_URL}/api/auth/me").json()["xp"]
+        one = api_client.post(f"{BASE_URL}/api/tasks", json={"title": "TEST_Batch One"}).json()
+        two = api_client.post(f"{BASE_URL}/api/tasks", json={"title": "TEST_Batch Two"}).json()
+        
+        response = api_client.post(f"{BASE_URL}/api/tasks/batch", json={"operations": [
+            {"op": "create", "data": {"title": "TEST_Batch Created"}},
+            {"op": "complete", "task_id": one["task_id"]},
+            {"op": "delete", "task_id": two["task_id"]},
+            {"op": "update", "task_id": "task_missing", "data": {"title": "x"}},
+            {"op": "explode", "task_id": one["task_id"]}
+        ]})
+        assert response.status_code == 200
+        
+        statuses = [r["status"] for r in response.json()["results"]]
+        assert statuses == ["created", "completed", "deleted", "not_found", "error"]
+        
+        me = api_client.get(f"{BASE_URL}/api/auth/me").json()
+        assert me["xp"] > initial_xp
+        assert api_client.get(f"{BASE_URL}/api/tasks/{two['task_id']}").status_code == 404
+    
+    def test_batch_update_reclassifies_persona(self, guest_user, api_client):
+        """Renaming a task through /tasks/batch should recompute its persona like PUT does"""
+        task = api_client.post(f"{BASE_URL}/api/tasks", json={"title": "TEST_Pay rent"}).json()
+        assert task["persona_id"] == "financial"
+        
+        response = api_client.post(f"{BASE_URL}/api/tasks/batch", json={"operations": [
+            {"op": "update", "task_id": task["task_id"], "data": {"title": "TEST_Go running"}}
+        ]})
+        assert [r["status"] for r in response.json()["results"]] == ["updated"]
+        
+        updated = api_client.get(f"{BASE_URL}/api/tasks/{task['task_id']}").json()
+        assert updated["persona_id"] == "fitness"
+        assert updated["persona_name"] == "Fitness Coach"
+    
     def test_toggle_subtask(self, guest_user, api_client):
         """Should toggle subtask completion"""
         # Create task with subtask
@@ -281,7 +399,14 @@ class TestTasksCRUD:
         assert toggle_resp.status_code == 200
         
         result = toggle_resp.json()
-        assert result["subtasks"][0]["completed"] == True
+        assert result["subtask"]["subtask_id"] == subtask_id
+        assert result["subtask"]["completed"] == True
+        
+        # Toggling again flips it back; unknown ids are a 404
+        again = api_client.put(f"{BASE_URL}/api/tasks/{task['task_id']}/subtask/{subtask_id}").json()
+        assert again["subtask"]["completed"] == False
+        missing = api_client.put(f"{BASE_URL}/api/tasks/{task['task_id']}/subtask/st_missing")
+        assert missing.status_code == 404
     
     def test_delete_task(self, guest_user, api_client):
         """Should delete a task"""
@@ -297,6 +422,38 @@ class TestTasksCRUD:
         get_resp = api_client.get(f"{BASE_URL}/api/tasks/{task['task_id']}")
         assert get_resp.status_code == 404
 
+class TestConditionalGet:
+    """ETags keyed on the per-user data version"""
+    
+    @pytest.mark.parametrize("path", ["/api/tasks", "/api/dashboard", "/api/gamification/stats", "/api/notifications/unread-count"])
+    def test_unchanged_data_returns_304(self, guest_user, api_client, path):
+        first = api_client.get(f"{BASE_URL}{path}")
+        assert first.status_code == 200
+        etag = first.headers["ETag"]
+        
+        again = api_client.get(f"{BASE_URL}{path}", headers={"If-None-Match": etag})
+        assert again.status_code == 304
+    
+    def test_mutation_invalidates_etag(self, guest_user, api_client):
+        etag = api_client.get(f"{BASE_URL}/api/tasks").headers["ETag"]
+        api_client.post(f"{BASE_URL}/api/tasks", json={"title": "TEST_ETag Task"})
+        
+        response = api_client.get(f"{BASE_URL}/api/tasks", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert any(t["title"] == "TEST_ETag Task" for t in response.json())
+
+    def test_etag_not_shared_across_users(self, guest_user, api_client):
+        etag = api_client.get(f"{BASE_URL}/api/tasks").headers["ETag"]
+        
+        other = requests.post(f"{BASE_URL}/api/auth/guest").json()
+        response = requests.get(
+            f"{BASE_URL}/api/tasks",
+            headers={"Authorization": f"Bearer {other['token']}", "If-None-Match": etag}
+        )
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
 class TestAIFeatures:
     """Test AI integration"""
     
@@ -313,6 +470,48 @@ class TestAIFeatures:
         assert "category" in suggestion
         assert suggestion["priority"] in ["high", "medium", "low"]
     
+    def test_ai_suggest_rules_fast_path(self, guest_user, api_client):
+        """Titles with clear keywords should be answered by the local rules"""
+        payload = {"title": f"Study for math exam tomorrow {int(time.time() * 1000)}"}
+        response = api_client.post(f"{BASE_URL}/api/ai/suggest", json=payload)
+        assert response.status_code == 200
+        
+        suggestion = response.json()
+        assert suggestion["source"] == "rules"
+        assert suggestion["category"] == "school"
+        assert suggestion["suggested_due"] == "tomorrow"
+        assert suggestion["priority"] == "high"
+    
+    def test_ai_suggest_concurrent_identical_titles(self, guest_user, api_client):
+        """Concurrent suggests for one uncached title should share a single result"""
+        from concurrent.futures import ThreadPoolExecutor
+        payload = {"title": f"Plan reunion {int(time.time() * 1000)}"}
+        headers = dict(api_client.headers)
+        
+        def suggest(_):
+            return requests.post(f"{BASE_URL}/api/ai/suggest", json=payload, headers=headers)
+        
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            responses = list(pool.map(suggest, range(4)))
+        assert all(r.status_code == 200 for r in responses)
+        results = [r.json() for r in responses]
+        assert all(r == results[0] for r in results)
+        
+        stats = api_client.get(f"{BASE_URL}/api/dev/cache-stats").json()["suggest_flight"]
+        assert stats["in_flight"] == 0
+    
+    def test_ai_suggest_normalized_titles_share_cache(self, guest_user, api_client):
+        """Case, punctuation, stopword and word-order variants should hit the same cache entry"""
+        stamp = int(time.time() * 1000)
+        first = api_client.post(f"{BASE_URL}/api/ai/suggest", json={"title": f"Renew the passport at the embassy {stamp}"})
+        assert first.status_code == 200
+        if first.json().get("timeout"):
+            pytest.skip("LLM timed out; nothing was cached")
+        
+        variant = api_client.post(f"{BASE_URL}/api/ai/suggest", json={"title": f"  {stamp} embassy: renew passport!"})
+        assert variant.status_code == 200
+        assert variant.json() == first.json()
+    
     def test_ai_breakdown_task(self, guest_user, api_client):
         """AI breakdown should return subtasks"""
         payload = {"title": "Complete math homework"}
@@ -327,6 +526,25 @@ class TestAIFeatures:
             assert "title" in result["subtasks"][0]
             assert "estimated_time" in result["subtasks"][0]
     
+    def test_ai_breakdown_cached(self, guest_user, api_client):
+        """Repeat breakdowns should come from cache; refresh=true regenerates"""
+        payload = {"title": f"Organize garage shelves {int(time.time() * 1000)}"}
+        first = api_client.post(f"{BASE_URL}/api/ai/breakdown", json=payload)
+        assert first.status_code == 200
+        if first.json()["subtasks"][0]["title"] == "Get started":
+            pytest.skip("LLM unavailable; fallback breakdowns are not cached")
+        before = api_client.get(f"{BASE_URL}/api/dev/cache-stats").json()["ai_cache"]["memory"]["hits"]
+        
+        again = api_client.post(f"{BASE_URL}/api/ai/breakdown", json=payload)
+        assert again.status_code == 200
+        assert again.json() == first.json()
+        after = api_client.get(f"{BASE_URL}/api/dev/cache-stats").json()["ai_cache"]["memory"]["hits"]
+        assert after > before
+        
+        refreshed = api_client.post(f"{BASE_URL}/api/ai/breakdown?refresh=true", json=payload)
+        assert refreshed.status_code == 200
+        assert "subtasks" in refreshed.json()
+    
     def test_ai_chat_basic(self, guest_user, api_client):
         """AI chat should respond to messages"""
         payload = {
@@ -342,6 +560,52 @@ class TestAIFeatures:
         assert "ai_model" in data
         assert len(data["response"]) > 0
     
+    def test_ai_chat_long_session(self, guest_user, api_client):
+        """Sessions longer than the recent window should keep working turn after turn"""
+        session_id = None
+        for i in range(5):
+            payload = {"message": f"Remember the number {i}", "ai_model": "claude", "session_id": session_id}
+            response = api_client.post(f"{BASE_URL}/api/ai/chat", json=payload)
+            assert response.status_code == 200
+            session_id = response.json()["session_id"]
+        
+        history = api_client.get(f"{BASE_URL}/api/ai/chat-history", params={"session_id": session_id}).json()
+        assert len(history) == 10
+        
+        # Paged newest-first, each page displayed oldest-first
+        page = api_client.get(f"{BASE_URL}/api/ai/chat-history", params={"session_id": session_id, "limit": 4}).json()
+        assert [m["message_id"] for m in page["messages"]] == [m["message_id"] for m in history[-4:]]
+        older = api_client.get(
+            f"{BASE_URL}/api/ai/chat-history",
+            params={"session_id": session_id, "limit": 4, "before": page["next_cursor"]}
+        ).json()
+        assert [m["message_id"] for m in older["messages"]] == [m["message_id"] for m in history[-8:-4]]
+    
+    def test_ai_chat_stream(self, guest_user, api_client):
+        """Streamed chat should emit meta, tokens and done, then persist the reply"""
+        payload = {"message": "Give me one productivity tip", "ai_model": "claude"}
+        response = api_client.post(f"{BASE_URL}/api/ai/chat/stream", json=payload, stream=True)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        
+        events = []
+        for frame in response.iter_lines(decode_unicode=True):
+            if frame.startswith("event: "):
+                events.append(frame[len("event: "):])
+            elif frame.startswith("data: "):
+                last_data = json.loads(frame[len("data: "):])
+        assert events[0] == "meta"
+        assert events[-1] == "done"
+        assert "token" in events
+        assert len(last_data["response"]) > 0
+        # Default config streams token by token, not one buffered reply
+        assert events.count("token") > 1
+        
+        time.sleep(0.5)
+        history = api_client.get(f"{BASE_URL}/api/ai/chat-history").json()
+        replies = [m for m in history if m["role"] == "assistant" and m["content"] == last_data["response"]]
+        assert len(replies) == 1
+    
     def test_ai_chat_model_switcher(self, guest_user, api_client):
         """Should support different AI models"""
         models = ["claude", "gpt4o", "gemini"]
@@ -404,6 +668,20 @@ class TestGamification:
             assert "day" in day
             assert "count" in day
     
+    def test_gamification_stats_activity_window(self, guest_user, api_client):
+        """days= should widen the activity histogram and reject unsupported windows"""
+        response = api_client.get(f"{BASE_URL}/api/gamification/stats?days=30")
+        assert response.status_code == 200
+        
+        stats = response.json()
+        assert len(stats["activity"]) == 30
+        assert len(stats["week_activity"]) == 7
+        assert stats["activity"][-7:] == stats["week_activity"]
+        assert "window_completed" in stats
+        
+        bad = api_client.get(f"{BASE_URL}/api/gamification/stats?days=12")
+        assert bad.status_code == 400
+    
     def test_badge_unlocking(self, guest_user, api_client):
         """Completing first task should unlock 'First Steps' badge"""
         # Create and complete a task
@@ -421,6 +699,40 @@ class TestGamification:
         
         badge_types = [b["badge_type"] for b in stats["badges"]]
         assert "first_task" in badge_types
+    
+    def test_task_counters_track_mutations(self, guest_user, api_client):
+        """total/completed counters should follow create, complete and delete"""
+        before = api_client.get(f"{BASE_URL}/api/gamification/stats").json()
+        
+        keep = api_client.post(f"{BASE_URL}/api/tasks", json={"title": "TEST_Counter Keep"}).json()
+        drop = api_client.post(f"{BASE_URL}/api/tasks", json={"title": "TEST_Counter Drop"}).json()
+        api_client.put(f"{BASE_URL}/api/tasks/{keep['task_id']}", json={"completed": True})
+        api_client.delete(f"{BASE_URL}/api/tasks/{drop['task_id']}")
+        
+        after = api_client.get(f"{BASE_URL}/api/gamification/stats").json()
+        assert after["total_tasks"] == before["total_tasks"] + 1
+        assert after["total_completed"] == before["total_completed"] + 1
+        assert after["completed_today"] == before["completed_today"] + 1
+        
+        rebuilt = api_client.post(f"{BASE_URL}/api/dev/reconcile-stats").json()["task_stats"]
+        assert rebuilt["total"] == after["total_tasks"]
+        assert rebuilt["completed"] == after["total_completed"]
+
+    def test_activity_history(self, guest_user, api_client):
+        """Completing a task should show up in the daily activity rollup"""
+        task = api_client.post(f"{BASE_URL}/api/tasks", json={"title": "TEST_History Task", "estimated_time": 20}).json()
+        api_client.put(f"{BASE_URL}/api/tasks/{task['task_id']}", json={"completed": True})
+        
+        response = api_client.get(f"{BASE_URL}/api/gamification/history")
+        assert response.status_code == 200
+        
+        history = response.json()
+        assert history["total_completed"] >= 1
+        assert history["total_minutes"] >= 20
+        assert history["days"][-1]["date"] <= history["to"]
+        
+        bad = api_client.get(f"{BASE_URL}/api/gamification/history?from=2025-02-01&to=2025-01-01")
+        assert bad.status_code == 400
 
 class TestNotifications:
     """Test notification system"""
@@ -486,3 +798,45 @@ class TestUserProfile:
         assert updated_user["mascot"] == "star"
         assert updated_user["dark_mode"] == True
         assert updated_user["ai_preference"] == "gpt4o"
+    
+    def test_profile_update_visible_on_next_request(self, guest_user, api_client):
+        """Profile writes must refresh the cached user used by get_current_user"""
+        api_client.get(f"{BASE_URL}/api/auth/me")
+        api_client.put(f"{BASE_URL}/api/user/profile", json={"name": "Cached Name"})
+        
+        me = api_client.get(f"{BASE_URL}/api/auth/me").json()
+        assert me["name"] == "Cached Name"
+    
+    def test_cache_stats(self, guest_user, api_client):
+        """Should expose user cache hit/miss counters"""
+        api_client.get(f"{BASE_URL}/api/auth/me")
+        response = api_client.get(f"{BASE_URL}/api/dev/cache-stats")
+        assert response.status_code == 200
+        
+        stats = response.json()["user_cache"]
+        for key in ["hits", "misses", "hit_rate", "size"]:
+            assert key in stats
+        
+        ai_cache = response.json()["ai_cache"]
+        for key in ["hits", "misses", "hit_rate", "bytes", "evictions"]:
+            assert key in ai_cache["memory"]
+        assert ai_cache["ttl"] > 3600
+        for kind in ["suggest", "breakdown"]:
+            assert "hit_rate" in ai_cache["mongo"][kind]
+    
+    def test_reclassify_personas_job(self, guest_user, api_client):
+        """Should run a persona reclassification job and report its progress"""
+        api_client.post(f"{BASE_URL}/api/tasks", json={"title": "TEST_Study for exams"})
+        response = api_client.post(f"{BASE_URL}/api/dev/reclassify-personas")
+        assert response.status_code == 200
+        job_id = response.json()["job_id"]
+        
+        for _ in range(20):
+            job = api_client.get(f"{BASE_URL}/api/dev/jobs/{job_id}").json()
+            if job["status"] != "running":
+                break
+            time.sleep(0.5)
+        assert job["status"] == "completed"
+        assert job["processed"] >= 1
+        assert job["scope"] == guest_user["user"]["user_id"]
+        assert api_client.get(f"{BASE_URL}/api/dev/jobs/job_not_mine").status_code == 404
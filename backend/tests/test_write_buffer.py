@@ -0,0 +1,118 @@
+"""
+Write-behind buffer tests with an in-memory collection
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from write_buffer import WriteBehindBuffer
+
+
+class MemoryCollection:
+    def __init__(self, name, failures=0, delay=0):
+        self.name = name
+        self.docs = []
+        self.calls = 0
+        self.failures = failures
+        self.delay = delay
+
+    async def insert_many(self, docs, ordered=True):
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("mongo unavailable")
+        self.docs.extend(docs)
+
+
+class TestWriteBehindBuffer:
+    def test_batches_in_order_and_flushes_on_close(self):
+        """Inserts are grouped into one insert_many per collection, in add() order"""
+        async def scenario():
+            chats, personas = MemoryCollection("chat_messages"), MemoryCollection("persona_chats")
+            buffer = WriteBehindBuffer(flush_interval=60)
+            await buffer.start()
+            for i in range(5):
+                buffer.add(chats, {"n": i})
+            buffer.add(personas, {"n": 0})
+            assert chats.docs == []
+            await buffer.close()
+            return chats, personas, buffer.stats()
+
+        chats, personas, stats = asyncio.run(scenario())
+        assert [d["n"] for d in chats.docs] == [0, 1, 2, 3, 4]
+        assert chats.calls == 1 and len(personas.docs) == 1
+        assert stats == {"queued": 0, "written": 6, "flushes": 2, "dropped": 0}
+
+    def test_transient_failure_is_retried_ahead_of_newer_docs(self):
+        """A failed batch goes back to the front of the queue and is retried after a backoff"""
+        async def scenario():
+            chats = MemoryCollection("chat_messages", failures=3)
+            buffer = WriteBehindBuffer(flush_interval=0.01, max_backoff=0.02)
+            await buffer.start()
+            buffer.add(chats, {"n": 0})
+            await buffer.flush()
+            buffer.add(chats, {"n": 1})
+            await asyncio.sleep(0.2)
+            await buffer.close()
+            return chats, buffer.stats()
+
+        chats, stats = asyncio.run(scenario())
+        assert [d["n"] for d in chats.docs] == [0, 1]
+        assert stats["dropped"] == 0
+
+    def test_gives_up_after_retry_budget(self):
+        """Documents are dropped only once the retry budget is spent"""
+        async def scenario():
+            chats = MemoryCollection("chat_messages", failures=1000)
+            buffer = WriteBehindBuffer(flush_interval=0.01, retry_budget=0.1, max_backoff=0.02)
+            buffer.add(chats, {"n": 0})
+            await buffer.close()
+            return chats, buffer.stats()
+
+        chats, stats = asyncio.run(scenario())
+        assert chats.calls > 2
+        assert stats == {"queued": 0, "written": 0, "flushes": 0, "dropped": 1}
+
+    def test_close_waits_for_in_flight_flush(self):
+        """Closing mid-flush must not lose the batches that flush had already taken"""
+        async def scenario():
+            slow, other = MemoryCollection("chat_messages", delay=0.05), MemoryCollection("persona_chats")
+            buffer = WriteBehindBuffer(flush_interval=0.01)
+            await buffer.start()
+            buffer.add(slow, {"n": 0})
+            buffer.add(other, {"n": 0})
+            await asyncio.sleep(0.03)  # the loop is now inside slow.insert_many
+            await buffer.close()
+            return slow, other
+
+        slow, other = asyncio.run(scenario())
+        assert len(slow.docs) == 1 and len(other.docs) == 1
+
+    def test_queue_is_bounded(self):
+        """Past max_queue the oldest documents are dropped"""
+        chats = MemoryCollection("chat_messages")
+        buffer = WriteBehindBuffer(max_queue=3)
+        for i in range(5):
+            buffer.add(chats, {"n": i})
+        asyncio.run(buffer.flush())
+        assert [d["n"] for d in chats.docs] == [2, 3, 4]
+        assert buffer.stats()["dropped"] == 2
+
+    def test_add_after_close_raises(self):
+        """Documents added once the buffer is closed are refused, not silently left unwritten"""
+        async def scenario():
+            chats = MemoryCollection("chat_messages")
+            buffer = WriteBehindBuffer(flush_interval=60)
+            await buffer.start()
+            buffer.add(chats, {"n": 0})
+            await buffer.close()
+            with pytest.raises(RuntimeError):
+                buffer.add(chats, {"n": 1})
+            return chats
+
+        assert [d["n"] for d in asyncio.run(scenario()).docs] == [0]
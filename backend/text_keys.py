@@ -0,0 +1,62 @@
+"""Title canonicalization and fuzzy matching for TASKLY's AI result caches"""
+
+import hashlib
+import math
+import re
+import unicodedata
+from typing import List
+
+# Words that rarely change what a task is about ("Study for the math exam" ~ "study math exam")
+STOPWORDS = frozenset({
+    "a", "an", "the", "and", "or", "but", "for", "to", "of", "in", "on", "at", "by", "with",
+    "from", "up", "about", "into", "my", "me", "i", "our", "your", "some", "this", "that",
+    "it", "is", "be", "get", "do", "go", "need", "needs", "should", "must", "please", "let", "s"
+})
+
+_SPLIT = re.compile(r"[\W_]+")
+
+
+def _stem(token: str) -> str:
+    """Conservative suffix folding: plurals and -ing, never below 3 characters."""
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 5 and token.endswith("ing"):
+        return token[:-3]
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def canonical_title(title: str, stem: bool = True) -> str:
+    """Fold case, punctuation, whitespace, stopwords and word order into one key string.
+
+    Titles made only of stopwords keep them; titles with no word characters at
+    all (e.g. just emoji) fall back to the stripped lowercase title.
+    """
+    text = unicodedata.normalize("NFKC", title).lower()
+    tokens = [t for t in _SPLIT.split(text) if t]
+    if not tokens:
+        return text.strip()
+    kept = [t for t in tokens if t not in STOPWORDS] or tokens
+    if stem:
+        kept = [_stem(t) for t in kept]
+    return " ".join(sorted(set(kept)))
+
+
+def canonical_key(canonical: str) -> str:
+    return hashlib.md5(canonical.encode()).hexdigest()
+
+
+def trigrams(canonical: str) -> List[str]:
+    """Sorted, de-duplicated character trigrams of a canonical title (padded at the edges)."""
+    padded = f"  {canonical} "
+    return sorted({padded[i:i + 3] for i in range(len(padded) - 2)})
+
+
+def probe_size(gram_count: int, threshold: float) -> int:
+    """How many of a title's trigrams a candidate must share at least one of.
+
+    Jaccard >= t implies an overlap of at least ceil(t * |A|) trigrams, so any
+    |A| - ceil(t * |A|) + 1 of them are enough to find every qualifying match.
+    """
+    return max(1, gram_count - math.ceil(threshold * gram_count) + 1)
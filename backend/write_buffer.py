@@ -0,0 +1,153 @@
+"""Write-behind buffering for TASKLY's append-only collections"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Queues inserts in memory and writes them with one insert_many per collection.
+
+    `add()` returns immediately; a background loop flushes every
+    `flush_interval` seconds, or sooner once `max_batch` documents are queued.
+    Documents keep their `add()` order within a collection. Readers that need
+    read-your-writes call `flush()` first; it also waits for a flush already in
+    progress. `close()` stops the loop after its current flush and writes
+    whatever is left; `add()` after that raises instead of queueing documents
+    nothing would write.
+
+    A batch that fails for a transient reason (e.g. a primary election) goes
+    back to the front of the queue and is retried with exponential backoff, up
+    to `max_backoff` between attempts, for `retry_budget` seconds from the
+    first failure before being dropped (logged). While a collection is backing
+    off, at most `max_queue` of its documents are kept; the oldest go first.
+    """
+
+    def __init__(self, flush_interval: float = 0.05, max_batch: int = 500, retry_budget: float = 30.0,
+                 max_backoff: float = 2.0, max_queue: int = 50000):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.retry_budget = retry_budget
+        self.max_backoff = max_backoff
+        self.max_queue = max_queue
+        self._pending: Dict[str, Tuple[Any, List[dict]]] = {}
+        # collection -> (first failure, next attempt, current backoff), monotonic seconds
+        self._retry: Dict[str, Tuple[float, float, float]] = {}
+        self._lock = asyncio.Lock()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._closed = False
+        self.written = 0
+        self.flushes = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return sum(len(docs) for _, docs in self._pending.values())
+
+    def add(self, collection, doc: dict):
+        if self._closed:
+            raise RuntimeError(f"Write-behind buffer is closed; cannot queue a {collection.name} document")
+        queued = self._pending.setdefault(collection.name, (collection, []))[1]
+        queued.append(doc)
+        self._bound(collection.name, queued)
+        if self._wake is not None and len(self) >= self.max_batch:
+            self._wake.set()
+
+    def _bound(self, name: str, queued: List[dict]):
+        overflow = len(queued) - self.max_queue
+        if overflow > 0:
+            del queued[:overflow]
+            self.dropped += overflow
+            logger.error(f"Write-behind queue for {name} is full; dropped {overflow} oldest documents")
+
+    def _requeue(self, name: str, collection, docs: List[dict]):
+        queued = self._pending.setdefault(name, (collection, []))[1]
+        queued[:0] = docs
+        self._bound(name, queued)
+
+    async def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._closed = False
+            self._wake = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        self._closed = True
+        task, self._task = self._task, None
+        if task is not None:
+            # Let the loop finish its current flush rather than cancelling it mid-write
+            self._stopping = True
+            self._wake.set()
+            await task
+        while self._pending:
+            await self.flush(force=True)
+            if self._retry:
+                next_attempt = min(retry[1] for retry in self._retry.values())
+                await asyncio.sleep(max(0.0, next_attempt - time.monotonic()))
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:  # never let the loop die
+                logger.error(f"Write-behind flush failed: {e}")
+
+    async def flush(self, force: bool = False):
+        """Write everything queued, except collections still backing off (unless `force`)."""
+        async with self._lock:
+            now = time.monotonic()
+            batches = []
+            for name in list(self._pending):
+                retry = self._retry.get(name)
+                if force or retry is None or retry[1] <= now:
+                    batches.append((name, *self._pending.pop(name)))
+            for i, (name, collection, docs) in enumerate(batches):
+                try:
+                    await self._write(name, collection, docs)
+                except asyncio.CancelledError:
+                    # Batches not yet attempted go back to the queue
+                    for rest_name, rest_collection, rest_docs in batches[i + 1:]:
+                        self._requeue(rest_name, rest_collection, rest_docs)
+                    raise
+
+    async def _write(self, name: str, collection, docs: List[dict]):
+        try:
+            await collection.insert_many(docs, ordered=True)
+            self.written += len(docs)
+            self.flushes += 1
+            self._retry.pop(name, None)
+        except BulkWriteError as e:
+            # Ordered: everything before the failing document was written
+            failed_at = e.details["writeErrors"][0]["index"]
+            self.written += failed_at
+            self.dropped += 1
+            logger.error(f"Write-behind dropped a {name} document: {e.details['writeErrors'][0].get('errmsg')}")
+            if failed_at + 1 < len(docs):
+                await self._write(name, collection, docs[failed_at + 1:])
+        except Exception as e:
+            now = time.monotonic()
+            first_failure, _, backoff = self._retry.get(name, (now, now, self.flush_interval / 2))
+            if now - first_failure >= self.retry_budget:
+                self._retry.pop(name, None)
+                self.dropped += len(docs)
+                logger.error(f"Write-behind gave up on {len(docs)} {name} documents after {now - first_failure:.1f}s: {e}")
+                return
+            backoff = min(backoff * 2, self.max_backoff)
+            self._retry[name] = (first_failure, now + backoff, backoff)
+            logger.warning(f"Write-behind requeued {len(docs)} {name} documents, retrying in {backoff:.2f}s: {e}")
+            self._requeue(name, collection, docs)
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": len(self), "written": self.written, "flushes": self.flushes, "dropped": self.dropped}
@@ -4,9 +4,12 @@ const API_BASE = process.env.EXPO_PUBLIC_BACKEND_URL;
 
 class ApiClient {
   private token: string | null = null;
+  // Last ETag + body per GET endpoint; lets the server answer 304 on re-polls
+  private etagCache: Map<string, { etag: string; body: any }> = new Map();
 
   async setToken(token: string) {
     this.token = token;
+    this.etagCache.clear();
     await AsyncStorage.setItem('auth_token', token);
   }
 
@@ -19,6 +22,7 @@ class ApiClient {
 
   async clearToken() {
     this.token = null;
+    this.etagCache.clear();
     await AsyncStorage.removeItem('auth_token');
   }
 
@@ -31,13 +35,26 @@ class ApiClient {
     if (token) {
       headers['Authorization'] = `Bearer ${token}`;
     }
+    const isGet = (options.method || 'GET').toUpperCase() === 'GET';
+    const cached = isGet ? this.etagCache.get(endpoint) : undefined;
+    if (cached) {
+      headers['If-None-Match'] = cached.etag;
+    }
     const url = `${API_BASE}/api${endpoint}`;
     const response = await fetch(url, { ...options, headers });
+    if (response.status === 304 && cached) {
+      return cached.body;
+    }
     if (!response.ok) {
       const error = await response.json().catch(() => ({ detail: 'Request failed' }));
       throw new Error(error.detail || 'Request failed');
     }
-    return response.json();
+    const body = await response.json();
+    const etag = response.headers.get('ETag');
+    if (isGet && etag) {
+      this.etagCache.set(endpoint, { etag, body });
+    }
+    return body;
   }
 
   // Auth
@@ -111,6 +128,13 @@ class ApiClient {
     return this.fetch(`/tasks/${taskId}`, { method: 'DELETE' });
   }
 
+  async batchTasks(operations: Array<{ op: string; task_id?: string; data?: Record<string, any> }>) {
+    return this.fetch('/tasks/batch', {
+      method: 'POST',
+      body: JSON.stringify({ operations }),
+    });
+  }
+
   async toggleSubtask(taskId: string, subtaskId: string) {
     return this.fetch(`/tasks/${taskId}/subtask/${subtaskId}`, { method: 'PUT' });
   }
@@ -123,8 +147,8 @@ class ApiClient {
     });
   }
 
-  async aiBreakdown(title: string) {
-    return this.fetch('/ai/breakdown', {
+  async aiBreakdown(title: string, refresh: boolean = false) {
+    return this.fetch(refresh ? '/ai/breakdown?refresh=true' : '/ai/breakdown', {
       method: 'POST',
       body: JSON.stringify({ title }),
     });